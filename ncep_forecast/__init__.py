@@ -1,13 +1,67 @@
 import os
+import json
+import mimetypes
 
-from flask import Flask, render_template, abort, send_file
+from flask import Flask, render_template, abort, send_file, request, Response
+from werkzeug.utils import safe_join
 
 from ncep_wave.cache import (
     Cache,
-    DEFAULT_CACHE
+    DEFAULT_CACHE,
+    read_spectrum_image_hs
+)
+from ncep_wave.compression import (
+    ENCODING_SUFFIXES,
+    MIN_COMPRESS_SIZE,
+    available_encodings,
+    compress
+)
+from ncep_wave.stations import StationIndex, STATION_INDEX
+from ncep_wave.profiles import (
+    RENDER_PROFILES,
+    DEFAULT_PROFILE,
+    DEFAULT_FORMAT,
+    IMAGE_MIMETYPES
 )
 
 CACHE_ENV = "NCEP_FORECAST_CACHE"
+MAX_NEAREST_STATIONS = 100
+
+# Dynamic responses of these types are compressed on the fly
+COMPRESS_MIMETYPES = ("application/json", "text/html")
+
+
+def requested_encoding():
+    """ Returns the preferred content encoding that the client accepts, or None
+    """
+    for encoding in available_encodings():
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def send_precompressed(path, mimetype, **kwargs):
+    """ Sends the precompressed copy of the file when there is one in an encoding that the client accepts
+    """
+    encoding = requested_encoding()
+    if encoding is not None and os.path.isfile(path + ENCODING_SUFFIXES[encoding]):
+        response = send_file(path + ENCODING_SUFFIXES[encoding], mimetype=mimetype, **kwargs)
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_file(path, mimetype=mimetype, **kwargs)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def requested_image_format(profile):
+    """ Chooses the image format from the format query parameter or, failing that, the Accept header
+    """
+    fmt = request.args.get("format")
+    if fmt is not None:
+        return fmt
+    if "webp" in RENDER_PROFILES[profile]["formats"] and "image/webp" in request.accept_mimetypes.values():
+        return "webp"
+    return DEFAULT_FORMAT
 
 
 def create_app():
@@ -17,16 +71,98 @@ def create_app():
     cache_path = os.environ[CACHE_ENV] if CACHE_ENV in os.environ else DEFAULT_CACHE
     cache = Cache(cache_path, auto_clean=False, read_only=True)
     print(f"cache: {cache._index._index}")
+    # For the event streams, which are served next to the app (see server.py)
+    app.config["CACHE_PATH"] = cache.path
+
+    # Rendered templates, kept until the index changes
+    rendered = {}
+
+    def send_static(filename):
+        """ Serves the build's precompressed copy of a static file when the client accepts its encoding
+        """
+        path = safe_join(app.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype, _ = mimetypes.guess_type(filename)
+        return send_precompressed(path, mimetype, max_age=app.get_send_file_max_age(filename))
+
+    app.view_functions["static"] = send_static
+
+    # The station index, kept until its file changes
+    station_index = {"mtime": None, "index": None}
+
+    def get_station_index():
+        path = os.path.join(cache.path, STATION_INDEX)
+        mtime = Cache.Index.modified_time(path)
+        if mtime is None:
+            return None
+        if mtime != station_index["mtime"]:
+            station_index.update(mtime=mtime, index=StationIndex.load(path))
+        return station_index["index"]
+
+    @app.before_request
+    def refresh_index():
+        # Only a stat of each file, unless the index or the snapshot was rewritten
+        index_changed = cache.refresh_if_changed()
+        snapshot_changed = cache.snapshot.refresh_if_changed()
+        if index_changed or snapshot_changed:
+            rendered.clear()
 
     @app.route("/")
     def index():
-        cache.refresh()
-        print(f"stations: {cache.station_data}")
-        return render_template("index.html", stations=cache.station_data)
+        if "index" not in rendered:
+            print(f"stations: {cache.station_data}")
+            rendered["index"] = render_template("index.html", stations=cache.station_data,
+                                                snapshot=cache.snapshot.snapshot)
+        return rendered["index"]
+
+    @app.route("/snapshot")
+    def get_snapshot():
+        if "snapshot" not in rendered:
+            rendered["snapshot"] = json.dumps(cache.snapshot.snapshot)
+        response = Response(rendered["snapshot"], mimetype="application/json")
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app.route("/snapshot/sprite.png")
+    def get_snapshot_sprite():
+        if not os.path.exists(cache.snapshot.sprite_path):
+            abort(404, "No snapshot available")
+        return send_file(cache.snapshot.sprite_path, mimetype="image/png")
+
+    @app.route("/stations/near")
+    def get_nearest_stations():
+        lat = request.args.get("lat", type=float)
+        lon = request.args.get("lon", type=float)
+        k = request.args.get("k", default=5, type=int)
+        if lat is None or lon is None or not -90 <= lat <= 90:
+            abort(400, "lat and lon must be given, with -90 <= lat <= 90")
+        if not 0 < k <= MAX_NEAREST_STATIONS:
+            abort(400, f"k must be between 1 and {MAX_NEAREST_STATIONS}")
+
+        index = get_station_index()
+        if index is None:
+            abort(404, "No station index available")
+        return {"stations": [
+            {
+                "station": station,
+                "lat": slat,
+                "lon": slon,
+                "distance_km": round(distance, 1),
+                "name": cache.get_station_name(station),
+                "forecast": cache.get_latest_forecast_run_time(station) is not None,
+            }
+            for station, slat, slon, distance in index.nearest(lat, lon, k)
+        ]}
 
     @app.route("/forecast/<station>")
     def station(station):
-        return render_template("forecast.html", station=station)
+        if station not in cache.station_data:
+            return render_template("forecast.html", station=station)
+        key = ("forecast", station)
+        if key not in rendered:
+            rendered[key] = render_template("forecast.html", station=station)
+        return rendered[key]
 
     @app.route("/latest/<station>")
     def get_latest_forecast_run(station):
@@ -43,19 +179,77 @@ def create_app():
         print(f"times: {spectrum_times}")
         return {station: spectrum_times}
 
+    @app.route("/forecast/<station>/bundle")
+    def get_forecast_bundle(station):
+        profile = request.args.get("profile", DEFAULT_PROFILE)
+        if profile not in RENDER_PROFILES:
+            abort(400, f"Unknown render profile: {profile}")
+        bundle = cache.get_forecast_bundle(station, profile)
+        if bundle is None:
+            abort(404, f"No forecast bundle available for {station}")
+        # conditional enables If-None-Match and Range requests, so interrupted downloads can be resumed
+        return send_file(bundle, mimetype="application/x-tar", as_attachment=True,
+                         download_name=f"{station}.{os.path.basename(bundle)}", conditional=True)
+
+    @app.route("/forecast/<station>/spectra")
+    def get_spectra(station):
+        """ The whole latest run as one binary payload (see ncep_wave.payload), for rendering in the browser
+        """
+        payload = cache.get_spectra_payload(station)
+        if payload is None:
+            abort(404, f"No spectra available for {station}")
+        return send_precompressed(payload, "application/octet-stream")
+
+    @app.route("/forecast/<station>/partitions")
+    def get_partitions(station):
+        """ The swell and wind sea partitions of every record in the latest run (see ncep_wave.partition)
+        """
+        partitions = cache.get_forecast_partitions(station)
+        if partitions is None:
+            abort(404, f"No partitions available for {station}")
+        return send_precompressed(partitions, "application/json")
+
     @app.route("/forecast/<station>/<fc_time>")
     def get_forecast(station, fc_time):
-        spectrums = cache.get_latest_forecast(station)
-        if spectrums is None:
-            abort(404, f"No forecast available for {station} station")
-        for spec in spectrums:
-            if fc_time in spec:
-                return send_file(spec, mimetype="image/png")
-        abort(404, f"No forecast available for {station}/{fc_time}")
+        profile = request.args.get("profile", DEFAULT_PROFILE)
+        if profile not in RENDER_PROFILES:
+            abort(400, f"Unknown render profile: {profile}")
+        fmt = requested_image_format(profile)
+        if fmt not in IMAGE_MIMETYPES:
+            abort(400, f"Unknown image format: {fmt}")
+
+        canonical = cache.get_spectrum_image(station, fc_time)
+        if canonical is None:
+            abort(404, f"No forecast available for {station}/{fc_time}")
+
+        # Fall back to the canonical image for runs that were rendered without this profile
+        spec = cache.get_spectrum_image(station, fc_time, profile, fmt)
+        if spec is None:
+            spec, fmt = canonical, DEFAULT_FORMAT
+
+        response = send_file(spec, mimetype=IMAGE_MIMETYPES[fmt])
+        response.headers["X-Hs"] = str(read_spectrum_image_hs(canonical))
+        response.vary.add("Accept")
+        return response
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+                or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = requested_encoding()
+        data = response.get_data()
+        if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
 
     @app.after_request
     def add_cors_headers(response):
         response.headers.add("Access-Control-Allow-Origin", "*")
+        response.headers.add("Access-Control-Expose-Headers", "X-Hs")
         return response
 
     return app
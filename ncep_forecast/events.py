@@ -0,0 +1,142 @@
+""" Pushes new forecast runs to the browser, as server-sent events
+
+The event streams are served by Twisted directly, next to the WSGI app (see server.py), rather than by Flask: a stream
+that stays open would hold one of the WSGI thread pool's threads for as long as the page is open, so a handful of open
+pages would stop the server from answering anything else. Here an open stream is just a request that hasn't finished
+yet, and nothing runs for it until there's something to send.
+
+One watcher checks the cache index for all of the server's clients, so the cost of keeping clients up to date grows
+with the number of new runs, rather than with the number of clients times how often they poll.
+"""
+import json
+
+from twisted.internet import reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from ncep_wave.cache import Cache
+
+# How often (s) the watcher checks the index, which is only a stat until it changes
+WATCH_INTERVAL = 2
+
+# How often (s) an idle stream sends a comment, so that the server notices clients that have gone away
+KEEPALIVE_INTERVAL = 15
+
+# Streams are closed after this long (s), and the browser reconnects after RECONNECT_DELAY (ms)
+STREAM_TIMEOUT = 600
+RECONNECT_DELAY = 5000
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class RunWatcher:
+    """ Watches the cache index for new forecast runs, and sends them to each station's streams
+
+    Everything runs in the reactor's thread, so nothing needs a lock.
+    """
+
+    def __init__(self, cache_path):
+        self._cache_path = cache_path
+        self._streams = {}
+        self._latest = {}
+        self._cache = None
+        self._watch = None
+        self._keepalive = None
+
+    def latest(self, station):
+        return self._latest.get(station)
+
+    def subscribe(self, station, request):
+        """ Sends the station's latest run to the request straight away, then each new run as it arrives
+        """
+        if self._watch is None:
+            # The watcher starts with the first stream, so that just creating the server doesn't start it
+            try:
+                self._read_latest()
+            except Exception as e:
+                print(f"Unable to read the cache index: {e}")
+            self._watch = task.LoopingCall(self._check)
+            self._watch.start(WATCH_INTERVAL, now=False)
+            self._keepalive = task.LoopingCall(self._send_keepalives)
+            self._keepalive.start(KEEPALIVE_INTERVAL, now=False)
+
+        self._streams.setdefault(station, set()).add(request)
+        request.write(f"retry: {RECONNECT_DELAY}\n\n".encode())
+        request.write(format_event("run", {station: self.latest(station)}).encode())
+
+        timeout = reactor.callLater(STREAM_TIMEOUT, request.finish)
+
+        def finished(_):
+            # Called both when the stream times out and when the client goes away
+            if timeout.active():
+                timeout.cancel()
+            self.unsubscribe(station, request)
+        request.notifyFinish().addBoth(finished)
+
+    def unsubscribe(self, station, request):
+        streams = self._streams.get(station, set())
+        streams.discard(request)
+        if not streams:
+            self._streams.pop(station, None)
+
+    def _read_latest(self):
+        if self._cache is None:
+            self._cache = Cache(self._cache_path, auto_clean=False, read_only=True)
+        elif not self._cache.refresh_if_changed():
+            return {}
+        latest = {station: self._cache.get_latest_forecast_run_time(station) for station in self._cache.station_data}
+        changed = {station: run for station, run in latest.items() if self._latest.get(station) != run}
+        self._latest = latest
+        return changed
+
+    def _check(self):
+        try:
+            changed = self._read_latest()
+        except Exception as e:
+            # Keep watching, the index will be read again once it changes
+            print(f"Unable to read the cache index: {e}")
+            return
+        for station, run in changed.items():
+            event = format_event("run", {station: run}).encode()
+            for request in list(self._streams.get(station, ())):
+                request.write(event)
+
+    def _send_keepalives(self):
+        for streams in list(self._streams.values()):
+            for request in list(streams):
+                request.write(b": keep-alive\n\n")
+
+
+class EventsResource(Resource):
+    """ Serves /events/<station>: server-sent events of the station's new forecast runs, for clients to update without
+    polling
+    """
+    isLeaf = True
+
+    def __init__(self, watcher: RunWatcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def _station(self, request):
+        if len(request.postpath) != 1 or not request.postpath[0]:
+            return None
+        request.setHeader(b"Content-Type", b"text/event-stream")
+        request.setHeader(b"Cache-Control", b"no-cache")
+        request.setHeader(b"X-Accel-Buffering", b"no")
+        return request.postpath[0].decode()
+
+    def render_GET(self, request):
+        station = self._station(request)
+        if station is None:
+            request.setResponseCode(404)
+            return b"Not found"
+        self.watcher.subscribe(station, request)
+        return NOT_DONE_YET
+
+    def render_HEAD(self, request):
+        # Without a body to send, there's nothing to keep the stream open for
+        if self._station(request) is None:
+            request.setResponseCode(404)
+        return b""
@@ -0,0 +1,31 @@
+""" The root resource for serving the app with Twisted, which adds the event streams to the WSGI app
+
+    twistd web --class ncep_forecast.server.Root
+
+/events/ is served by events.py, in the reactor's thread, and everything else by the Flask app, in the reactor's
+thread pool.
+"""
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.wsgi import WSGIResource
+
+from ncep_forecast import app
+from ncep_forecast.events import RunWatcher, EventsResource
+
+
+class Root(Resource):
+
+    def __init__(self):
+        super().__init__()
+        self.wsgi = WSGIResource(reactor, reactor.getThreadPool(), app)
+        # One watcher of the index pushes new runs to every event stream
+        self.putChild(b"events", EventsResource(RunWatcher(app.config["CACHE_PATH"])))
+
+    def getChild(self, path, request):
+        # Hand the whole path to the app
+        request.prepath.pop()
+        request.postpath.insert(0, path)
+        return self.wsgi
+
+    def render(self, request):
+        return self.wsgi.render(request)
@@ -32,6 +32,302 @@ async function getHsFromImage(image) {
     return dv.getFloat64(0, true);
 }
 
+/* Chooses the render profile that best fits the viewport
+ */
+function chooseProfile() {
+    const size = Math.min(window.innerWidth, window.innerHeight) * (window.devicePixelRatio || 1);
+    if (size < 600)
+        return "mobile";
+    return "desktop";
+}
+
+/* Lookup table for decoding IEEE half precision floats
+ */
+const HALF_FLOATS = (() => {
+    let table = new Float32Array(65536);
+    for (let h = 0; h < 65536; h++) {
+        const sign = (h & 0x8000) ? -1 : 1;
+        const exp = (h >> 10) & 0x1f;
+        const frac = h & 0x3ff;
+        if (exp == 0)
+            table[h] = sign * Math.pow(2, -14) * (frac / 1024);
+        else if (exp == 0x1f)
+            table[h] = frac ? NaN : sign * Infinity;
+        else
+            table[h] = sign * Math.pow(2, exp - 15) * (1 + frac / 1024);
+    }
+    return table;
+})();
+
+/* Parses the spectra payload of a whole forecast run (see ncep_wave/payload.py)
+ */
+function parseSpectra(buf) {
+    const magic = String.fromCharCode(...new Uint8Array(buf, 0, 4));
+    if (magic != "NCSP")
+        throw new Error(`Bad spectra payload: ${magic}`);
+    const header = new DataView(buf, 4, 8);
+    const version = header.getUint16(0, true);
+    if (version != 2)
+        throw new Error(`Unsupported spectra payload version: ${version}`);
+    const nrecords = header.getUint16(2, true);
+    const ndirs = header.getUint16(4, true);
+    const nfreqs = header.getUint16(6, true);
+
+    let offset = 12;
+    const take = (type, n) => {
+        const a = new type(buf, offset, n);
+        offset += n * type.BYTES_PER_ELEMENT;
+        return a;
+    };
+    let spectra = {nrecords: nrecords, ndirs: ndirs, nfreqs: nfreqs};
+    spectra.freqs = take(Float32Array, nfreqs);
+    spectra.dirs = take(Float32Array, ndirs);
+    spectra.times = take(Uint32Array, nrecords);
+    spectra.windSpeed = take(Float32Array, nrecords);
+    spectra.windDir = take(Float32Array, nrecords);
+    spectra.hs = take(Float32Array, nrecords);
+
+    const halfs = take(Uint16Array, nrecords * ndirs * nfreqs);
+
+    // The server's names for the records (YYYYMMDDHH, in its timezone), which its images and partitions are keyed by
+    const names = new TextDecoder("ascii").decode(take(Uint8Array, nrecords * 10));
+    spectra.names = Array.from({length: nrecords}, (_, r) => names.slice(10 * r, 10 * (r + 1)));
+
+    spectra.data = new Float32Array(halfs.length);
+    for (let i = 0; i < halfs.length; i++)
+        spectra.data[i] = HALF_FLOATS[halfs[i]];
+
+    // The maximum of each record sets its contour levels
+    spectra.maxima = new Float32Array(nrecords);
+    const n = ndirs * nfreqs;
+    for (let r = 0; r < nrecords; r++) {
+        let max = 0;
+        for (let i = r * n; i < (r + 1) * n; i++)
+            max = Math.max(max, spectra.data[i]);
+        spectra.maxima[r] = max;
+    }
+    return spectra;
+}
+
+function hexToRGB(hex) {
+    return [1, 3, 5].map(i => parseInt(hex.slice(i, i + 2), 16));
+}
+
+/* Draws spectra as polar contour bands on a canvas, in the same style as the server's plots (see plotter.py)
+ *
+ * The mapping from each pixel to the spectrum grid only depends on the grid and the canvas size, so it is computed once
+ * and each frame is then just an interpolation and a band lookup per pixel.
+ */
+class SpectrumCanvas {
+
+    static RMAX = 0.35;  // Outer frequency (Hz)
+    static NLEVELS = 17;
+    static COLORS = ["#0066ff", "#00b7ff", "#00e0ff", "#00ffff", "#00ffcc",
+                     "#00ff99", "#00ff00", "#99ff00", "#ccff00", "#ffff00", "#ffcc00",
+                     "#ff9900", "#ff6600", "#ff0000", "#b03060", "#d02090"].map(hexToRGB);
+    static UNDER = hexToRGB("#0000cd");
+    static OVER = hexToRGB("#ff00ff");
+    static BACKGROUND = hexToRGB("#141b1d");
+    static FACE = [255, 255, 255];
+
+    // Pixel classes, other than the bands
+    static OUTSIDE = -2;
+    static NO_DATA = -1;
+
+    constructor(canvas, spectra) {
+        this.canvas = canvas;
+        this.ctx = canvas.getContext("2d");
+        this.spectra = spectra;
+        this.resize(Math.min(600, window.innerWidth));
+    }
+
+    resize(cssSize) {
+        const dpr = window.devicePixelRatio || 1;
+        const size = Math.round(cssSize * dpr);
+        this.canvas.width = size;
+        this.canvas.height = size;
+        this.canvas.style.width = `${cssSize}px`;
+        this.canvas.style.height = `${cssSize}px`;
+        this.size = size;
+        this.image = this.ctx.createImageData(size, size);
+        this.bands = new Int8Array(size * size);
+
+        const {freqs, dirs, nfreqs, ndirs} = this.spectra;
+        const twoPi = 2 * Math.PI;
+
+        // Plot angle of each direction, as normalized by the plotter, and the directions in order of angle
+        const angles = Array.from(dirs, d => twoPi - (((d - Math.PI / 2) % twoPi) + twoPi) % twoPi);
+        const order = angles.map((_, i) => i).sort((a, b) => angles[a] - angles[b]);
+        const sorted = order.map(i => angles[i]);
+
+        const n = size * size;
+        this.dir0 = new Int32Array(n);
+        this.dir1 = new Int32Array(n);
+        this.wdir = new Float32Array(n);
+        this.freq0 = new Int32Array(n);
+        this.wfreq = new Float32Array(n);
+
+        const c = size / 2;
+        for (let y = 0; y < size; y++) {
+            for (let x = 0; x < size; x++) {
+                const p = y * size + x;
+                const dx = x + 0.5 - c;
+                const dy = c - (y + 0.5);
+                const f = Math.sqrt(dx * dx + dy * dy) / c * SpectrumCanvas.RMAX;
+                if (f > SpectrumCanvas.RMAX) {
+                    this.freq0[p] = SpectrumCanvas.OUTSIDE;
+                    continue;
+                }
+                if (f < freqs[0] || f >= freqs[nfreqs - 1]) {
+                    this.freq0[p] = SpectrumCanvas.NO_DATA;
+                    continue;
+                }
+
+                // Frequency bin, by bisection
+                let lo = 0, hi = nfreqs - 1;
+                while (hi - lo > 1) {
+                    const mid = (lo + hi) >> 1;
+                    if (freqs[mid] <= f) lo = mid; else hi = mid;
+                }
+                this.freq0[p] = lo;
+                this.wfreq[p] = (f - freqs[lo]) / (freqs[lo + 1] - freqs[lo]);
+
+                // Direction bin, wrapping around from the last direction to the first
+                const phi = ((Math.atan2(dy, dx) % twoPi) + twoPi) % twoPi;
+                let k = ndirs - 1;
+                for (let i = 0; i < ndirs - 1; i++) {
+                    if (sorted[i] <= phi && phi < sorted[i + 1]) {
+                        k = i;
+                        break;
+                    }
+                }
+                const next = (k + 1) % ndirs;
+                const span = ((sorted[next] - sorted[k]) % twoPi + twoPi) % twoPi;
+                const offset = ((phi - sorted[k]) % twoPi + twoPi) % twoPi;
+                this.dir0[p] = order[k] * nfreqs;
+                this.dir1[p] = order[next] * nfreqs;
+                this.wdir[p] = span > 0 ? offset / span : 0;
+            }
+        }
+    }
+
+    draw(record) {
+        const {data, nfreqs, ndirs} = this.spectra;
+        const size = this.size;
+        const pixels = this.image.data;
+        const bands = this.bands;
+        const base = record * ndirs * nfreqs;
+
+        // Levels are spaced evenly in log2, from 2^-5 up to the record's maximum
+        const step = (Math.log2(this.spectra.maxima[record]) + 5) / SpectrumCanvas.NLEVELS;
+        const palette = [SpectrumCanvas.UNDER, ...SpectrumCanvas.COLORS, SpectrumCanvas.OVER];
+
+        for (let p = 0; p < bands.length; p++) {
+            const j = this.freq0[p];
+            let color;
+            if (j == SpectrumCanvas.OUTSIDE) {
+                bands[p] = SpectrumCanvas.OUTSIDE;
+                color = SpectrumCanvas.BACKGROUND;
+            } else if (j == SpectrumCanvas.NO_DATA) {
+                bands[p] = SpectrumCanvas.NO_DATA;
+                color = SpectrumCanvas.FACE;
+            } else {
+                const i0 = base + this.dir0[p] + j;
+                const i1 = base + this.dir1[p] + j;
+                const wf = this.wfreq[p];
+                const wd = this.wdir[p];
+                const v = (1 - wd) * ((1 - wf) * data[i0] + wf * data[i0 + 1])
+                    + wd * ((1 - wf) * data[i1] + wf * data[i1 + 1]);
+                let band = 0;
+                if (v >= 1 / 32)
+                    band = Math.min(Math.floor((Math.log2(v) + 5) / step), SpectrumCanvas.NLEVELS - 1) + 1;
+                bands[p] = band;
+                color = palette[band];
+            }
+            pixels[4 * p] = color[0];
+            pixels[4 * p + 1] = color[1];
+            pixels[4 * p + 2] = color[2];
+            pixels[4 * p + 3] = 255;
+        }
+
+        // Contour lines wherever the band changes
+        for (let y = 0; y < size - 1; y++) {
+            for (let x = 0; x < size - 1; x++) {
+                const p = y * size + x;
+                const b = bands[p];
+                if (b < 0) continue;
+                const right = bands[p + 1];
+                const below = bands[p + size];
+                if ((right >= 0 && right != b) || (below >= 0 && below != b)) {
+                    pixels[4 * p] = 0;
+                    pixels[4 * p + 1] = 0;
+                    pixels[4 * p + 2] = 0;
+                }
+            }
+        }
+        this.ctx.putImageData(this.image, 0, 0);
+
+        this.drawGrid();
+        this.drawWind(record);
+    }
+
+    drawGrid() {
+        const ctx = this.ctx;
+        const c = this.size / 2;
+        ctx.save();
+        ctx.strokeStyle = "#b0b0b0";
+        ctx.lineWidth = 0.8 * (window.devicePixelRatio || 1);
+        for (let a = 0; a < 8; a++) {
+            const theta = a * Math.PI / 4;
+            ctx.beginPath();
+            ctx.moveTo(c, c);
+            ctx.lineTo(c + c * Math.cos(theta), c - c * Math.sin(theta));
+            ctx.stroke();
+        }
+
+        // Rings, labelled with their periods (s)
+        ctx.fillStyle = "white";
+        ctx.font = `${Math.round(this.size / 50)}px sans-serif`;
+        ctx.textAlign = "center";
+        const labelAngle = (22.5 + 245) * Math.PI / 180;
+        for (let f = 0.05; f <= SpectrumCanvas.RMAX + 1e-6; f += 0.05) {
+            const r = f / SpectrumCanvas.RMAX * c;
+            ctx.beginPath();
+            ctx.arc(c, c, r, 0, 2 * Math.PI);
+            ctx.stroke();
+            ctx.fillText((1 / f).toFixed(1), c + r * Math.cos(labelAngle), c - r * Math.sin(labelAngle));
+        }
+        ctx.restore();
+    }
+
+    drawWind(record) {
+        // Scaled so each radial tick is 10mph, and translated from the oceanographer's direction convention
+        const ctx = this.ctx;
+        const c = this.size / 2;
+        const length = this.spectra.windSpeed[record] / (140 / 2.237) * this.size;
+        const theta = Math.PI * (90 - this.spectra.windDir[record]) / 180 + Math.PI;
+        const x = c + length * Math.cos(theta);
+        const y = c - length * Math.sin(theta);
+        const head = Math.min(length / 3, this.size / 40);
+
+        ctx.save();
+        ctx.strokeStyle = "red";
+        ctx.fillStyle = "red";
+        ctx.lineWidth = this.size / 200;
+        ctx.beginPath();
+        ctx.moveTo(c, c);
+        ctx.lineTo(x, y);
+        ctx.stroke();
+        ctx.beginPath();
+        ctx.moveTo(x, y);
+        ctx.lineTo(x - head * Math.cos(theta - 0.4), y + head * Math.sin(theta - 0.4));
+        ctx.lineTo(x - head * Math.cos(theta + 0.4), y + head * Math.sin(theta + 0.4));
+        ctx.closePath();
+        ctx.fill();
+        ctx.restore();
+    }
+}
+
 /* Manages the playback of the images for a particular station
  */
 class ForecastPlayer {
@@ -46,23 +342,81 @@ class ForecastPlayer {
         this.fctime_index = 0;
 
         this.latest_forecast = null;
-        this.newDataTimer = setInterval(() => this.checkForNewData(), 60000);
+        this.newDataTimer = null;
+        this.generation = 0;
 
         this.mouse_on = null;
         this.shifted = false;
         this.fetching = false
+        this.profile = chooseProfile();
     }
 
-    async init(image_id, date_id, hs_id, container_id) {
+    async init(image_id, date_id, hs_id, container_id, canvas_id=null) {
         this.image = document.getElementById(image_id)
         this.image.ondragstart = () => { return false; }
         // this.image.ontouchstart = this.image.onclick;
+        this.view = this.image;
 
         this.date = document.getElementById(date_id)
         this.hs = document.getElementById(hs_id)
         this.container = document.getElementById(container_id)
 
-        this.fctimes = await this.getLatestForecastTimes();
+        // Render the spectra in the browser when we can, otherwise fall back to the server's images
+        const canvas = canvas_id ? document.getElementById(canvas_id) : null;
+        if (canvas && canvas.getContext && await this.fetchSpectra()) {
+            this.renderer = new SpectrumCanvas(canvas, this.spectra);
+            this.image.hidden = true;
+            canvas.hidden = false;
+            this.view = canvas;
+            this.forecast_times = this.spectra.names;
+            this.fctimes = this.forecast_times;
+            this.latest_forecast = await this.getLatestForecastRun();
+        }
+        else {
+            this.renderer = null;
+            this.fctimes = await this.getLatestForecastTimes();
+        }
+        this.watchForNewData();
+    }
+
+    /* Listens for new forecast runs from the server, or polls for them if the server can't push them
+     */
+    watchForNewData() {
+        const poll = () => {
+            if (this.newDataTimer === null)
+                this.newDataTimer = setInterval(() => this.checkForNewData(), 60000);
+        };
+        if (!window.EventSource) {
+            poll();
+            return;
+        }
+        const events = new EventSource(`/events/${this.station}`);
+        events.addEventListener("run", (event) => {
+            const latest = JSON.parse(event.data)[this.station];
+            if (latest !== null && latest != this.latest_forecast)
+                this.loadRun(latest);
+        });
+        events.onerror = () => {
+            // The browser reconnects by itself unless the server turned the stream away
+            if (events.readyState === EventSource.CLOSED)
+                poll();
+        };
+    }
+
+    /* Fetches the whole run's spectra in one payload. Returns false if they aren't available
+     */
+    async fetchSpectra() {
+        try {
+            const response = await fetch(`/forecast/${this.station}/spectra`);
+            if (!response.ok)
+                return false;
+            this.spectra = parseSpectra(await response.arrayBuffer());
+            return true;
+        }
+        catch (e) {
+            console.log(`Unable to use the spectra payload: ${e}`);
+            return false;
+        }
     }
 
     async fetchLatestForecastTimes() {
@@ -95,22 +449,65 @@ class ForecastPlayer {
 
     async checkForNewData() {
         let latest = await this.getLatestForecastRun();
-        if (this.latest_forecast != null && latest != this.latest_forecast) {
-            window.location.reload();
+        if (latest != null && latest != this.latest_forecast) {
+            await this.loadRun(latest);
         }
     }
 
+    /* Replaces the current run with a new one, in place
+     */
+    async loadRun(latest) {
+        if (this.latest_forecast == null) {
+            // The first we've heard of the run that was loaded with the page
+            this.latest_forecast = latest;
+            return;
+        }
+        this.latest_forecast = latest;
+        this.generation++;
+
+        if (this.renderer) {
+            if (!await this.fetchSpectra())
+                return;
+            this.renderer = new SpectrumCanvas(this.renderer.canvas, this.spectra);
+            this.forecast_times = this.spectra.names;
+            this.fctimes = this.forecast_times;
+        }
+        else {
+            for (const url of Object.values(this.forecasts))
+                window.URL.revokeObjectURL(url);
+            this.forecasts = {};
+            this.fetching = false;
+            this.forecast_times = null;
+            await this.fetchLatestForecastTimes();
+            this.fctimes = this.forecast_times;
+            this.fetchForecasts();
+        }
+        this.fctime_index = Math.min(this.fctime_index, this.fctimes.length - 1);
+        await this.updateSpectrum(this.fctime_index);
+    }
+
     async fetchForecasts() {
         if (!this.fetching) {
             this.fetching = true
+            const generation = this.generation;
             for (let i=0; i<this.fctimes.length; i++) {
                 const fctime = this.fctimes[i]
-                const response = await fetch(`/forecast/${this.station}/${fctime}`);
+                const response = await fetch(`/forecast/${this.station}/${fctime}?profile=${this.profile}`,
+                                             {headers: {"Accept": "image/webp,image/png"}});
+                // Stop if a new run has replaced this one, which fetches its own images
+                if (generation !== this.generation)
+                    return;
                 if (response.ok) {
                     // Get the image and create a url
                     let image = await response.blob();
                     this.forecasts[fctime] = window.URL.createObjectURL(image);
-                    this.hs[fctime] = await getHsFromImage(image);  // Get significant wave height
+
+                    // Get significant wave height, which only the png images carry in-band
+                    const hs = response.headers.get("X-Hs");
+                    if (hs !== null)
+                        this.hs[fctime] = parseFloat(hs);
+                    else
+                        this.hs[fctime] = await getHsFromImage(image);
                 }
             }
             this.fetching = false
@@ -193,13 +590,21 @@ class ForecastPlayer {
 
         const fct = this.fctimes[fct_i];
 
-        // Try to get the image & move on if we can't
-        const forecast = await this.getForecast(fct);
-        if (!forecast) return
+        let hs;
+        if (this.renderer) {
+            this.renderer.draw(fct_i);
+            hs = this.spectra.hs[fct_i];
+        }
+        else {
+            // Try to get the image & move on if we can't
+            const forecast = await this.getForecast(fct);
+            if (!forecast) return
 
-        const [img_url, hs] = forecast
+            let img_url;
+            [img_url, hs] = forecast
 
-        this.image.src = img_url;
+            this.image.src = img_url;
+        }
 
         // Create date from forecast time
         const y = parseInt(fct.slice(0, 4));
@@ -246,7 +651,7 @@ class ForecastPlayer {
             break;
         case "mouseover":
             this.mouse_on = target;
-            if (target.id == "spectrum") {
+            if (target == this.view) {
                 this.was_running = this.run;
                 this.stop();
 
@@ -256,14 +661,14 @@ class ForecastPlayer {
             break;
         case "mouseout":
             this.mouse_on = null;
-            if (target.id == "spectrum") {
+            if (target == this.view) {
                 this.tearDownSpecAnimation();
                 window.removeEventListener("scroll", this);
                 if (this.was_running) this.play();
             }
             break;
         case "scroll":
-            if (this.mouse_on == document.getElementById("spectrum")) {
+            if (this.mouse_on == this.view) {
                 this.fctime_index = Math.floor((this.scroll_height - window.scrollY) / 10);
                 this.updateSpectrum(this.fctime_index);
             }
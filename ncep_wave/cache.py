@@ -1,19 +1,53 @@
 import os
 import time
 import glob
-import shutil
 import json
+import struct
 
 import ncep_wave.terminal as term
+from .profiles import DEFAULT_PROFILE, DEFAULT_FORMAT
+from .retention import Retention, DATA_GROUP
 
 DEFAULT_CACHE = os.path.expanduser("~/.cache/ncep-wave/")
 SPECTRUM_TIMESPEC = "%Y%m%d%H"
 FORECAST_TIMESPEC = "%Y-%m-%d-%H"
 
 
-def create_spectrum_image_path(forecast_dir, localtime):
-    pathtime = time.strftime(SPECTRUM_TIMESPEC, localtime)
-    return os.path.join(forecast_dir, f"{pathtime}.spec.png")
+def create_spectrum_image_path(forecast_dir, localtime, profile=DEFAULT_PROFILE, ext=DEFAULT_FORMAT):
+    if not isinstance(localtime, str):
+        localtime = time.strftime(SPECTRUM_TIMESPEC, localtime)
+    return os.path.join(forecast_dir, spectrum_image_name(localtime, profile, ext))
+
+
+def spectrum_image_name(pathtime, profile=DEFAULT_PROFILE, ext=DEFAULT_FORMAT):
+    """ Returns the file name of a spectrum image
+
+    The canonical (desktop png) image keeps the plain <time>.spec.png name, all other profiles and formats are named
+    <time>.spec.<profile>.<ext>
+    """
+    if profile == DEFAULT_PROFILE and ext == DEFAULT_FORMAT:
+        return f"{pathtime}.spec.png"
+    return f"{pathtime}.spec.{profile}.{ext}"
+
+
+SPECTRA_PAYLOAD = "spectra.bin"
+PARTITIONS = "partitions.json"
+
+
+def forecast_bundle_name(profile=DEFAULT_PROFILE):
+    return f"frames.{profile}.tar"
+
+
+def read_spectrum_image_hs(path):
+    """ Reads the significant wave height that the plotter wrote into a png's tEXt chunk
+    """
+    with open(path, "rb") as f:
+        header = f.read(1024)
+    itext = header.find(b"tEXt")
+    if itext < 0:
+        return None
+    itext += 4
+    return struct.unpack("<d", header[itext:itext + 8])[0]
 
 
 def spec_path_to_time(path):
@@ -36,17 +70,41 @@ class Cache:
                 self._write()
 
         def _read(self):
-            if os.path.exists(self._path):
+            self._mtime = Cache.Index.modified_time(self._path)
+            if self._mtime is not None:
                 with open(self._path) as f:
                     self._index = json.load(f)
             else:
                 self._index = {}
 
+        @staticmethod
+        def modified_time(path):
+            try:
+                return os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                return None
+
+        @property
+        def changed(self):
+            """ True if the index file has been written since it was read
+            """
+            return Cache.Index.modified_time(self._path) != self._mtime
+
         def _write(self):
             if self._updated and not self._read_only:
-                # Only write if we've actually created an index
-                with open(self._path, "w") as f:
+                # Only write if we've actually created an index. Write then rename, so that readers never see a
+                # partial index
+                tmp_path = self._path + ".tmp"
+                with open(tmp_path, "w") as f:
                     json.dump(self._index, f, indent=2)
+                os.replace(tmp_path, self._path)
+                self._mtime = Cache.Index.modified_time(self._path)
+                self._updated = False
+
+        def flush(self):
+            """ Writes any updates to the index now, rather than when it is deleted
+            """
+            self._write()
 
         @property
         def stations(self):
@@ -82,20 +140,74 @@ class Cache:
             for station in self.stations:
                 if station not in stations_to_keep:
                     self._index.pop(station)
+                    self._updated = True
 
         @property
         def index(self):
             return self._index
 
-    def __init__(self, path=DEFAULT_CACHE, auto_clean=None, read_only=False):
+    class Snapshot:
+        """ A summary of the latest forecast for every station, written once per forecast run
+
+        The snapshot comes with a sprite image of every station's current thumbnail, laid out left to right. Each
+        station's "sprite" entry is its position in the sprite.
+        """
+
+        def __init__(self, path):
+            self._path = path
+            self.sprite_path = os.path.splitext(path)[0] + ".png"
+            self._read()
+
+        def _read(self):
+            self._mtime = Cache.Index.modified_time(self._path)
+            if self._mtime is not None:
+                with open(self._path) as f:
+                    self._snapshot = json.load(f)
+            else:
+                self._snapshot = {"stations": {}}
+
+        def write(self, stations, run, sprite_size=None):
+            self._snapshot = {
+                "run": Cache._strftime(run),
+                "sprite_size": sprite_size,
+                "stations": stations,
+            }
+            # Write then rename, so that readers never see a partial snapshot
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._snapshot, f, indent=2)
+            os.replace(tmp_path, self._path)
+            self._mtime = Cache.Index.modified_time(self._path)
+
+        def refresh_if_changed(self):
+            if Cache.Index.modified_time(self._path) == self._mtime:
+                return False
+            self._read()
+            return True
+
+        @property
+        def stations(self):
+            return self._snapshot["stations"]
+
+        @property
+        def snapshot(self):
+            return self._snapshot
+
+    def __init__(self, path=DEFAULT_CACHE, auto_clean=None, read_only=False, retention: Retention = None):
         self._path = path
         self._image_cache = os.path.join(path, "forecast")
         self._auto_clean = auto_clean
         self._read_only = read_only
+        self._cleaned = False
         self.refresh()
+        self._snapshot = Cache.Snapshot(os.path.join(path, "snapshot.json"))
+        if read_only:
+            self._retention = None
+        else:
+            self._retention = retention if retention is not None else Retention(path)
 
     def __del__(self):
-        if self._auto_clean:
+        if self._auto_clean and not self._cleaned:
             self.clean()
 
     @property
@@ -110,6 +222,14 @@ class Cache:
     def station_data(self):
         return self._index.index
 
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def retention(self):
+        return self._retention
+
     @staticmethod
     def _strftime(t=None):
         if t is None:
@@ -136,6 +256,14 @@ class Cache:
         self._index = Cache.Index(os.path.join(self._path, "index.json"),
                                   read_only=self._read_only)
 
+    def refresh_if_changed(self):
+        """ Re-reads the index only if its file has changed. Returns True if it was re-read
+        """
+        if not self._index.changed:
+            return False
+        self.refresh()
+        return True
+
     def forecast_path(self, station, forecast_time=None):
         forecast_time = Cache._strftime(forecast_time)
         return os.path.join(self.image_cache, station, forecast_time)
@@ -150,6 +278,20 @@ class Cache:
                      name: str = None, location: (float, float) = None):
         self._index.update_station(station, forecast_time, name, location)
 
+    def add_data_run(self, path):
+        """ Records a newly fetched data run, so that older runs can be evicted
+        """
+        if not self._retention.contains(path):
+            self._retention.add(path, DATA_GROUP)
+
+    def add_forecast_run(self, station, forecast_time):
+        """ Records a newly rendered forecast, so that older forecasts can be evicted
+
+        The index is written first, so that it never points at a forecast that has been evicted
+        """
+        self._index.flush()
+        self._retention.add(self.forecast_path(station, forecast_time), station)
+
     def get_latest_forecast_run_time(self, station):
         return self._index.latest(station)
 
@@ -162,6 +304,50 @@ class Cache:
             return latest
         return self.forecast_path(station, forecast_time=latest)
 
+    def get_spectrum_image(self, station, fc_time, profile=DEFAULT_PROFILE, ext=DEFAULT_FORMAT):
+        """ Returns the path of the latest image for the given forecast time, profile and format, if it exists
+        """
+        forecast_dir = self._get_latest_forecast_dir(station)
+        if forecast_dir is None:
+            return None
+        path = os.path.join(forecast_dir, spectrum_image_name(fc_time, profile, ext))
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def get_forecast_bundle(self, station, profile=DEFAULT_PROFILE):
+        """ Returns the path of the latest frame bundle for the given profile, if it exists
+        """
+        forecast_dir = self._get_latest_forecast_dir(station)
+        if forecast_dir is None:
+            return None
+        path = os.path.join(forecast_dir, forecast_bundle_name(profile))
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def get_spectra_payload(self, station):
+        """ Returns the path of the latest run's spectra payload, if it exists
+        """
+        forecast_dir = self._get_latest_forecast_dir(station)
+        if forecast_dir is None:
+            return None
+        path = os.path.join(forecast_dir, SPECTRA_PAYLOAD)
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def get_forecast_partitions(self, station):
+        """ Returns the path of the latest run's spectral partitions, if they exist
+        """
+        forecast_dir = self._get_latest_forecast_dir(station)
+        if forecast_dir is None:
+            return None
+        path = os.path.join(forecast_dir, PARTITIONS)
+        if not os.path.exists(path):
+            return None
+        return path
+
     def get_latest_forecast(self, station):
         forecast_dir = self._get_latest_forecast_dir(station)
         term.message(f"Latest forecast dir: {forecast_dir}")
@@ -177,50 +363,39 @@ class Cache:
             return None
         return list(map(spec_path_to_time, forecast))
 
-    def old_data(self):
-        all_data = sorted(glob.glob(os.path.join(self._path, "gfs.*")))
-        if len(all_data) == 0:
-            return None, None
-        old_days = all_data[:-1]
-        latest_data = all_data[-1]
-        old_runs = sorted(glob.glob(os.path.join(latest_data, "*")))[:-1]
-        return old_days, old_runs
-
-    def clean(self):
-        # Clean up the data cache
-        old_days, old_runs = self.old_data()
-        if old_days is not None:
-            for od in old_days:
-                term.message(f"Removing old data directory {od}")
-                shutil.rmtree(od, ignore_errors=True)
-        if old_runs is not None:
-            for run in old_runs:
-                term.message(f"Removing old run directory {run}")
-                shutil.rmtree(run, ignore_errors=True)
-
-        # Clean up the image cache
-        print(f"auto clean? {self._auto_clean}")
+    def _stations_to_keep(self):
         if isinstance(self._auto_clean, (list, set)):
-            keep_stations = self._auto_clean
+            return self._auto_clean
         elif isinstance(self._auto_clean, dict):
-            keep_stations = self._auto_clean.keys()
+            return self._auto_clean.keys()
         else:
-            keep_stations = self._index.stations
+            return self._index.stations
 
-        print(f"keeping stations: {keep_stations}")
+    def start_clean(self):
+        """ Removes the stations that aren't kept, then starts evicting old runs in the background
 
-        station_caches = glob.glob(os.path.join(self.image_cache, "*"))
-        for station in station_caches:
-            if os.path.basename(station) in keep_stations:
-                # Remove all but the most recent forecast
-                forecasts = sorted(glob.glob(os.path.join(station, "*")))
-                for forecast in forecasts[:-1]:
-                    term.message(f"Removing old forecast {forecast}")
-                    shutil.rmtree(forecast, ignore_errors=True)
-            else:
-                # Remove the whole folder
-                print(f"Removing station: {station}")
-                shutil.rmtree(station)
+        Eviction carries on as new runs are added, until finish_clean() is called.
+        """
+        keep_stations = self._stations_to_keep()
+        print(f"keeping stations: {keep_stations}")
 
-        # Clean up index
+        # Clean up the index before removing the stations' forecasts, so that it never points at removed forecasts
         self._index.clean(keep_stations)
+        self._index.flush()
+
+        for group in self._retention.groups():
+            if group != DATA_GROUP and group not in keep_stations:
+                print(f"Removing station: {group}")
+                self._retention.drop_group(group)
+
+        self._retention.start()
+
+    def finish_clean(self):
+        """ Finishes evicting old runs
+        """
+        self._retention.stop()
+        self._cleaned = True
+
+    def clean(self):
+        self.start_clean()
+        self.finish_clean()
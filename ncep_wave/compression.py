@@ -0,0 +1,72 @@
+""" Compression helpers for the plotter's precompressed outputs and the web server
+
+Brotli is optional. If the brotli module isn't installed then only gzip is used.
+"""
+import os
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings in order of preference, with the suffix of their precompressed files
+ENCODING_SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".html", ".json", ".svg")
+
+# Responses smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def available_encodings():
+    """ Returns the encodings that can be produced, in order of preference
+    """
+    return [enc for enc in ENCODING_SUFFIXES if enc != "br" or brotli is not None]
+
+
+def compress(data: bytes, encoding: str, best=False):
+    """ Compresses the data with the given encoding
+
+    best selects the slowest, smallest compression, which is only worth it for data that is compressed once
+    """
+    if encoding == "br":
+        if brotli is None:
+            raise ValueError("brotli is not installed")
+        return brotli.compress(data, quality=11 if best else 5)
+    elif encoding == "gzip":
+        return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def precompress_file(path):
+    """ Writes a compressed copy of the file next to it for each available encoding
+
+    Returns the paths of the compressed files
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    outpaths = []
+    for encoding in available_encodings():
+        compressed = compress(data, encoding, best=True)
+        if len(compressed) >= len(data):
+            continue
+        outpath = path + ENCODING_SUFFIXES[encoding]
+        with open(outpath, "wb") as f:
+            f.write(compressed)
+        outpaths.append(outpath)
+    return outpaths
+
+
+def precompress_directory(path, extensions=PRECOMPRESS_EXTENSIONS):
+    """ Precompresses every file in the directory tree with one of the given extensions
+    """
+    outpaths = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(extensions):
+                outpaths += precompress_file(os.path.join(root, name))
+    return outpaths
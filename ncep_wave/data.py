@@ -8,6 +8,7 @@ from ftplib import FTP_TLS, error_temp
 import ncep_wave.terminal as term
 
 from .cache import DEFAULT_CACHE
+from .stations import update_station_index
 
 NCEP_SERVER = "ftpprd.ncep.noaa.gov"
 PRODUCT_PATH = "/pub/data/nccf/com/gfs/prod"
@@ -93,7 +94,12 @@ class NCEPWaveDataFetcher:
     def latest_spectrals(self):
         return self.latest_station_file(STATION_FILE.SPECTRAL)
 
-    def fetch_latest_spectrals(self, cache=DEFAULT_CACHE, remove_tar=True):
+    def fetch_latest_spectrals(self, cache=DEFAULT_CACHE, remove_tar=True, on_extracted=None):
+        """ Downloads and extracts the latest spectral run, returning the directory it was extracted to
+
+        If on_extracted is given, it is called with the path of each station file as soon as it has been extracted, so
+        that callers can start working on it while the rest of the run is extracted.
+        """
         # Get the target data, the output dirname and the output path
         target_tar = self.latest_spectrals()
         if target_tar is None:
@@ -106,6 +112,7 @@ class NCEPWaveDataFetcher:
         # TODO: Deal with case where tar file was only partially extracted
         if os.path.exists(output_path):
             term.message(f"Found latest spectral run: {output_path}")
+            update_station_index(cache, output_path)
             return output_path
 
         # We need the data, so download it
@@ -116,15 +123,18 @@ class NCEPWaveDataFetcher:
 
         # Now extract the tar file
         term.message(f"Extracting {output_tar} to {output_path}")
-        tf = tarfile.open(output_tar)
-        tf.extractall(output_path)
-        tf.close()
+        with tarfile.open(output_tar) as tf:
+            for member in tf:
+                tf.extract(member, output_path)
+                if on_extracted is not None and member.isfile():
+                    on_extracted(os.path.join(output_path, member.name))
         if remove_tar:
             os.remove(output_tar)
 
+        update_station_index(cache, output_path)
         return output_path
 
 
-def fetch_latest_spectral_data(cache=DEFAULT_CACHE):
+def fetch_latest_spectral_data(cache=DEFAULT_CACHE, on_extracted=None):
     with NCEPWaveDataFetcher() as wdf:
-        return wdf.fetch_latest_spectrals(cache)
+        return wdf.fetch_latest_spectrals(cache, on_extracted=on_extracted)
@@ -1,33 +1,330 @@
 import sys
 import os
+import glob
 import time
+import tarfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import ncep_wave.terminal as term
 from .data import fetch_latest_spectral_data
 from .spectrum import Spectrum
-from .plotter import plot_record
-from .cache import Cache
+from .plotter import plot_record, write_sprite
+from .cache import Cache, forecast_bundle_name, create_spectrum_image_path, SPECTRUM_TIMESPEC, SPECTRA_PAYLOAD, \
+    PARTITIONS
+from .compression import precompress_file
+from .payload import write_spectra_payload
+from .partition import write_partitions
+from .profiles import RENDER_PROFILES, DEFAULT_PROFILE
+from .workqueue import WorkQueue, QUEUE_DIR, DONE, FAILED
 
+# Records rendered by each queued job, and how often (s) an idle worker looks for new jobs
+RECORDS_PER_JOB = 8
+POLL_INTERVAL = 5
 
-def make_forecast(station: str, name: str, cache: Cache):
-    term.message(f"Generating forecast for station: {station}: {(name if name else None)}")
-    this_hour = time.localtime()
-    forecast_dir = cache.forecast_path(station, forecast_time=this_hour)
-    latest_spec = fetch_latest_spectral_data(cache.path)
-    if latest_spec is None:
-        term.message("Forecast failed")
-        return
 
-    spec_path = os.path.join(latest_spec, f"gfswave.{station}.spec")
+def write_bundles(forecast_dir, profiles):
+    """ Writes an uncompressed tar of each profile's images, for downloading a whole run at once
+
+    The images are already compressed, so the tars aren't.
+    """
+    for profile in profiles:
+        bundle_path = os.path.join(forecast_dir, forecast_bundle_name(profile))
+        images = sorted(glob.glob(os.path.join(forecast_dir, f"*.spec.{profile}.*")))
+        if profile == DEFAULT_PROFILE:
+            images += sorted(glob.glob(os.path.join(forecast_dir, "*.spec.png")))
+        with tarfile.open(bundle_path, "w") as tf:
+            for image in images:
+                tf.add(image, arcname=os.path.basename(image))
+        term.info(bundle_path)
+
+
+def summarize_forecast(records, forecast_dir, now=None):
+    """ Summarizes a station's forecast for the snapshot
+
+    The current record is the last one that isn't in the future
+    """
+    now = time.time() if now is None else now
+    current = records[0]
+    for rec in records:
+        if rec.rtime > now:
+            break
+        current = rec
+    peak = max(records, key=lambda rec: rec.hs)
+
+    thumbnail = create_spectrum_image_path(forecast_dir, time.localtime(current.rtime), "thumbnail", "png")
+    return {
+        "time": time.strftime(SPECTRUM_TIMESPEC, time.localtime(current.rtime)),
+        "hs": float(current.hs),
+        "tp": float(current.tp),
+        "dp": float(current.dp),
+        "peak_hs": float(peak.hs),
+        "peak_time": time.strftime(SPECTRUM_TIMESPEC, time.localtime(peak.rtime)),
+        "thumbnail": thumbnail if os.path.exists(thumbnail) else None,
+    }
+
+
+def carried_over_summaries(cache: Cache, summaries: dict):
+    """ Returns the previous snapshot's summaries of the stations that weren't rendered this time, as long as their run
+    is still the latest one in the index, so that a failed render doesn't drop a station from the snapshot
+    """
+    carried = {}
+    for station, summary in cache.snapshot.stations.items():
+        if station in summaries or summary.get("run") is None:
+            continue
+        if cache.get_latest_forecast_run_time(station) != summary["run"]:
+            continue
+        summary = dict(summary)
+        summary.pop("sprite", None)
+        thumbnail = create_spectrum_image_path(cache.forecast_path(station, summary["run"]), summary["time"],
+                                               "thumbnail", "png")
+        summary["thumbnail"] = thumbnail if os.path.exists(thumbnail) else None
+        carried[station] = summary
+    return carried
+
+
+def write_snapshot(cache: Cache, summaries: dict, run=None):
+    """ Writes the snapshot of every station's forecast, along with the sprite of their current thumbnails
+
+    Stations that weren't rendered this time keep their previous summaries.
+    """
+    stations = {}
+    thumbnails = []
+    summaries = dict(summaries, **carried_over_summaries(cache, summaries))
+    for station, summary in summaries.items():
+        summary = dict(summary)
+        thumbnail = summary.pop("thumbnail")
+        summary["sprite"] = None
+        if thumbnail is not None:
+            summary["sprite"] = len(thumbnails)
+            thumbnails.append(thumbnail)
+        stations[station] = summary
+
+    sprite_size = None
+    if thumbnails:
+        sprite_size = write_sprite(thumbnails, cache.snapshot.sprite_path)
+    cache.snapshot.write(stations, run, sprite_size)
+    term.info(cache.snapshot.sprite_path)
+
+
+def station_spec_path(spec_dir, station):
+    return os.path.join(spec_dir, f"gfswave.{station}.spec")
+
+
+def render_records(spec_path: str, forecast_dir: str, profiles=tuple(RENDER_PROFILES), start=0, stop=None,
+                   pathtimes=None):
+    """ Renders the plots of a range of a station's records into the forecast directory
+
+    The plots are named by each record's local time, unless the names (SPECTRUM_TIMESPEC strings) of the range's
+    records are given as pathtimes.
+    """
     spectrum = Spectrum(spec_path)
 
     term.message("Generating spectrum plots...")
     term.info(f"--- {forecast_dir} ---")
     os.makedirs(forecast_dir, exist_ok=True)
-    for rec in spectrum.records:
-        plot_record(rec, forecast_dir)
+    records = spectrum.read_all()[start:stop]
+    if pathtimes is None:
+        pathtimes = [None] * len(records)
+    for rec, pathtime in zip(records, pathtimes):
+        plot_record(rec, forecast_dir, profiles=profiles, pathtime=pathtime)
+    return spectrum
+
+
+def write_station_outputs(spectrum: Spectrum, forecast_dir: str, profiles=tuple(RENDER_PROFILES)):
+    """ Writes everything besides the plots into a station's forecast directory, and returns the station's summary
+    """
+    write_bundles(forecast_dir, profiles)
+
+    # The raw spectra, for clients that render them themselves
+    payload_path = os.path.join(forecast_dir, SPECTRA_PAYLOAD)
+    write_spectra_payload(spectrum, payload_path)
+    precompress_file(payload_path)
+    term.info(payload_path)
+
+    # The separate wave trains of every record
+    partitions_path = os.path.join(forecast_dir, PARTITIONS)
+    write_partitions(spectrum, partitions_path)
+    precompress_file(partitions_path)
+    term.info(partitions_path)
+
+    summary = summarize_forecast(spectrum.read_all(), forecast_dir)
+    summary.update(lat=spectrum.location[0], lon=spectrum.location[1])
+    return summary
+
+
+def render_station(spec_path: str, forecast_dir: str, profiles=tuple(RENDER_PROFILES)):
+    """ Parses a station's spectral file and renders all of its plots into the forecast directory
+
+    This doesn't touch the cache index, so it can run in a worker process. Returns the station's summary.
+    """
+    spectrum = render_records(spec_path, forecast_dir, profiles)
+    return write_station_outputs(spectrum, forecast_dir, profiles)
+
+
+def finish_forecast(cache: Cache, station: str, name: str, forecast_time, summary: dict):
+    """ Records a rendered station forecast in the cache index and returns its completed summary
+    """
+    cache.update_index(station, forecast_time, name, (summary["lat"], summary["lon"]))
+    cache.add_forecast_run(station, forecast_time)
+    summary.update(name=name, run=Cache._strftime(forecast_time))
+    return summary
+
+
+def make_forecasts(stations: dict, cache: Cache, profiles=tuple(RENDER_PROFILES), jobs=None):
+    """ Generates the forecasts for all of the stations, rendering them concurrently in worker processes
+
+    The spectral run is only fetched once. Each station is scheduled as soon as its file has been extracted, so
+    rendering overlaps with the rest of the extraction. Only this (coordinating) process updates the cache index.
+
+    Returns the summaries of the stations that were rendered.
+    """
+    this_hour = time.localtime()
+    summaries = {}
+
+    # Spawn rather than fork the workers, since the cache's retention thread may be running
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {}
+
+        def schedule(spec_path):
+            station = os.path.basename(spec_path)[len("gfswave."):-len(".spec")]
+            if station not in stations or station in futures or not os.path.exists(spec_path):
+                return
+            term.message(f"Generating forecast for station: {station}: {stations[station]}")
+            forecast_dir = cache.forecast_path(station, forecast_time=this_hour)
+            futures[station] = pool.submit(render_station, spec_path, forecast_dir, profiles)
+
+        latest_spec = fetch_latest_spectral_data(cache.path, on_extracted=schedule)
+        if latest_spec is None:
+            term.message("Forecast failed")
+            return summaries
+        cache.add_data_run(latest_spec)
+
+        # The run may already have been extracted by an earlier forecast
+        for station in stations:
+            schedule(station_spec_path(latest_spec, station))
+        for station in stations:
+            if station not in futures:
+                term.message(f"Forecast failed for station {station}: no spectral data")
+
+        stations_by_future = {future: station for station, future in futures.items()}
+        for future in as_completed(stations_by_future):
+            station = stations_by_future[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                term.message(f"Forecast failed for station {station}: {e}")
+                continue
+            summaries[station] = finish_forecast(cache, station, stations[station], this_hour, summary)
+
+    return summaries
+
+
+def run_job(cache_path: str, spec: dict):
+    """ Renders a queued job. Its paths are relative to the cache, which may be mounted in a different place on each
+    machine, and its plots are named by the coordinator's local times, which may differ from this machine's
+    """
+    render_records(os.path.join(cache_path, spec["spec_path"]), os.path.join(cache_path, spec["forecast_dir"]),
+                   spec["profiles"], spec["start"], spec["stop"], spec["pathtimes"])
+
+
+def work(cache_path: str, queue: WorkQueue, exit_when_empty=False):
+    """ Claims and renders jobs from the queue, forever or until the queue is empty
+    """
+    while True:
+        job = queue.claim()
+        if job is None:
+            if exit_when_empty:
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+        with job:
+            run_job(cache_path, job.spec)
+
+
+def make_queued_forecasts(stations: dict, cache: Cache, profiles=tuple(RENDER_PROFILES),
+                          records_per_job=RECORDS_PER_JOB):
+    """ Generates the forecasts for all of the stations by splitting them into jobs on the cache's work queue
+
+    Any number of workers (see work()), on any machine that shares the cache, render the jobs. This (coordinating)
+    process works on the queue too, requeues the jobs of workers that have died and, once all of a station's jobs are
+    done, writes the station's other outputs and updates the cache index.
+
+    Returns the summaries of the stations that were rendered.
+    """
+    this_hour = time.localtime()
+    run = Cache._strftime(this_hour)
+    queue = WorkQueue(os.path.join(cache.path, QUEUE_DIR))
+    jobs = {}
+
+    def enqueue(spec_path):
+        station = os.path.basename(spec_path)[len("gfswave."):-len(".spec")]
+        if station not in stations or station in jobs or not os.path.exists(spec_path):
+            return
+        pathtimes = [time.strftime(SPECTRUM_TIMESPEC, time.localtime(rec.rtime))
+                     for rec in Spectrum(spec_path).read_all()]
+        forecast_dir = cache.forecast_path(station, forecast_time=this_hour)
+        jobs[station] = []
+        for start in range(0, len(pathtimes), records_per_job):
+            name = f"{run}-{station}-{start:04d}"
+            queue.remove(name)
+            queue.put(name, {
+                "station": station,
+                "spec_path": os.path.relpath(spec_path, cache.path),
+                "forecast_dir": os.path.relpath(forecast_dir, cache.path),
+                "profiles": list(profiles),
+                "start": start,
+                "stop": start + records_per_job,
+                "pathtimes": pathtimes[start:start + records_per_job],
+            })
+            jobs[station].append(name)
+        term.message(f"Queued {len(jobs[station])} jobs for station: {station}: {stations[station]}")
+
+    latest_spec = fetch_latest_spectral_data(cache.path, on_extracted=enqueue)
+    if latest_spec is None:
+        term.message("Forecast failed")
+        return {}
+    cache.add_data_run(latest_spec)
+
+    # The run may already have been extracted by an earlier forecast
+    for station in stations:
+        enqueue(station_spec_path(latest_spec, station))
+    for station in stations:
+        if station not in jobs:
+            term.message(f"Forecast failed for station {station}: no spectral data")
+
+    summaries = {}
+    while jobs:
+        queue.requeue_stale()
+        for station, names in list(jobs.items()):
+            states = [queue.state(name) for name in names]
+            if FAILED in states:
+                name = names[states.index(FAILED)]
+                term.message(f"Forecast failed for station {station}: {queue.error(name)}")
+            elif None in states:
+                # e.g. removed by another coordinator of the same run
+                name = names[states.index(None)]
+                term.message(f"Forecast failed for station {station}: job {name} is missing from the queue")
+            elif all(state == DONE for state in states):
+                forecast_dir = cache.forecast_path(station, forecast_time=this_hour)
+                spectrum = Spectrum(station_spec_path(latest_spec, station))
+                summary = write_station_outputs(spectrum, forecast_dir, profiles)
+                summaries[station] = finish_forecast(cache, station, stations[station], this_hour, summary)
+            else:
+                continue
+            for name in names:
+                queue.remove(name)
+            del jobs[station]
+
+        if jobs:
+            job = queue.claim()
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            with job:
+                run_job(cache.path, job.spec)
 
-    cache.update_index(station, this_hour, name, spectrum.location)
+    return summaries
 
 
 def plot_binary_data(outdir: str, path: str = None):
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class SpectralGrid:
+    """ The frequency/direction grid of a spectrum, along with the arrays derived from it
+
+    Every station in a run shares the same grid, so grids are interned by their content: use SpectralGrid.get() rather
+    than the constructor, and the derived arrays are only computed once per process.
+    """
+
+    _grids = {}
+
+    @classmethod
+    def get(cls, freqs, dirs):
+        """ Returns the interned grid with the given frequencies (Hz) and directions (rads)
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        dirs = np.asarray(dirs, dtype=np.float64)
+        key = (freqs.tobytes(), dirs.tobytes())
+        grid = cls._grids.get(key)
+        if grid is None:
+            grid = cls._grids[key] = cls(freqs, dirs)
+        return grid
+
+    def __init__(self, freqs, dirs):
+        self.freqs = self._frozen(freqs)
+        self.dirs = self._frozen(dirs)
+        self.nfreqs = len(freqs)
+        self.ndirs = len(dirs)
+
+        # Ratio between neighbouring frequencies
+        df = self.freqs[1:]/self.freqs[:-1]
+        self.dfreqs = self._frozen(np.append(df, df[-1]))
+
+        # Bandwidths for the frequency bands, and the factor for the high frequency tail
+        bw = 0.5 * (self.dfreqs - 1/self.dfreqs) * self.freqs
+        bw[-1] *= 0.5
+        self.bandwidths = self._frozen(bw)
+        self.tail_factor = 0.25 * self.freqs[-1]
+
+        # Width of each direction bin
+        self.dtheta = 2 * np.pi / self.ndirs
+
+        # Indices of each direction's neighbours, wrapping around at the ends of the direction axis
+        self.dir_prev = self._frozen(np.roll(np.arange(self.ndirs), 1))
+        self.dir_next = self._frozen(np.roll(np.arange(self.ndirs), -1))
+
+        self._plot_dirs = {}
+        self._meshes = {}
+
+    @staticmethod
+    def _frozen(a):
+        a = np.array(a)
+        a.setflags(write=False)
+        return a
+
+    def integrate(self, data):
+        """ Returns the integral (m^2) of a spectrum, or of a stack of spectra with shape (..., ndirs, nfreqs)
+        """
+        dir_int = data.sum(axis=-2, dtype=np.float64) * self.dtheta
+        return dir_int @ self.bandwidths + self.tail_factor * dir_int[..., -1]
+
+    def plot_dirs(self, normalize_dirs=True, join_ends=True):
+        """ Returns the directions to plot the spectrum at
+
+        When normalized, the directions are rotated to the plot's convention. When the ends are joined, 0 and 2pi are
+        added to the ends to close the gap in the plot.
+        """
+        key = (normalize_dirs, join_ends)
+        if key not in self._plot_dirs:
+            if normalize_dirs:
+                dirs = (2 * np.pi) - (self.dirs - np.pi/2) % (2 * np.pi)
+            else:
+                dirs = self.dirs
+            if join_ends:
+                dirs = np.concatenate(([0], dirs, [2 * np.pi]))
+            self._plot_dirs[key] = self._frozen(dirs)
+        return self._plot_dirs[key]
+
+    def mesh(self, normalize_dirs=True, join_ends=True):
+        """ Returns the (r, theta) mesh of the plot's frequencies and directions
+        """
+        key = (normalize_dirs, join_ends)
+        if key not in self._meshes:
+            r, theta = np.meshgrid(self.freqs, self.plot_dirs(normalize_dirs, join_ends))
+            self._meshes[key] = (self._frozen(r), self._frozen(theta))
+        return self._meshes[key]
@@ -0,0 +1,145 @@
+""" Splits spectra into their separate wave trains (swell and wind sea)
+
+Every record of a run is partitioned at once. Each bin of the spectrum points at its highest neighbour (directions wrap
+around, frequencies don't), and following the pointers from any bin leads to a local peak. All of the bins that lead to
+the same peak are one partition. The pointers are followed for every bin at the same time, by repeatedly replacing each
+bin's pointer with its target's pointer, so this takes log(longest path) steps rather than a loop over the bins.
+"""
+import json
+import time
+
+import numpy as np
+
+from .cache import SPECTRUM_TIMESPEC
+
+GRAVITY = 9.81
+
+# Partitions smaller than this (m) are dropped, along with their energy
+MIN_HS = 0.1
+
+# The most partitions kept per record, the largest first
+MAX_PARTITIONS = 5
+
+# A partition is wind sea when the wind's speed in the partition's direction, scaled by this, is faster than the
+# partition's peak phase speed
+WIND_SEA_FACTOR = 1.5
+
+PARTITION_DTYPE = np.dtype([
+    ("hs", np.float32),
+    ("tp", np.float32),
+    ("dp", np.float32),
+    ("wind_sea", np.bool_),
+])
+
+# (direction, frequency) offsets of each bin's neighbours. The bin itself is first, so that a peak points at itself
+_NEIGHBOURS = [(0, 0)] + [(dd, df) for dd in (-1, 0, 1) for df in (-1, 0, 1) if dd or df]
+
+
+def _neighbour(padded, grid, dd, df):
+    """ Returns each bin's neighbour at the given (direction, frequency) offset, from spectra padded by one bin at each
+    end of the frequency axis. The directions wrap around, using the grid's neighbour indices
+    """
+    dirs = {-1: grid.dir_prev, 0: slice(None), 1: grid.dir_next}[dd]
+    return padded[:, dirs, 1 + df:1 + df + grid.nfreqs]
+
+
+def _smooth(data, grid):
+    """ Averages each bin with its neighbours, which keeps noise from splitting a wave train into several partitions
+    """
+    padded = np.pad(data, ((0, 0), (0, 0), (1, 1)), mode="edge")
+    total = np.zeros_like(data)
+    for dd, df in _NEIGHBOURS:
+        total += _neighbour(padded, grid, dd, df)
+    return total / len(_NEIGHBOURS)
+
+
+def _peaks(data, grid):
+    """ Returns the flat index of the peak that each bin of the (nrecords, ndirs, nfreqs) spectra climbs to
+    """
+    nrecords, ndirs, nfreqs = data.shape
+    padded = np.pad(data, ((0, 0), (0, 0), (1, 1)), constant_values=-np.inf)
+    neighbours = np.stack([_neighbour(padded, grid, dd, df) for dd, df in _NEIGHBOURS])
+    highest = np.argmax(neighbours, axis=0)
+
+    offsets = np.array(_NEIGHBOURS)
+    r, d, f = np.indices(data.shape)
+    d = np.choose(offsets[highest, 0] + 1, (grid.dir_prev[d], d, grid.dir_next[d]))
+    f = f + offsets[highest, 1]
+    peaks = ((r * ndirs + d) * nfreqs + f).ravel()
+
+    while True:
+        jumped = peaks[peaks]
+        if np.array_equal(jumped, peaks):
+            return peaks
+        peaks = jumped
+
+
+def partition(data, grid, wind_speed, wind_dir, max_partitions=MAX_PARTITIONS, min_hs=MIN_HS):
+    """ Partitions a stack of spectra with shape (nrecords, ndirs, nfreqs)
+
+    wind_speed (m/s) and wind_dir (degrees, the direction the wind comes from) are per record. Returns a
+    (nrecords, max_partitions) array of PARTITION_DTYPE, with each record's partitions largest first. Unused slots have
+    an hs of 0.
+    """
+    data = np.nan_to_num(np.asarray(data, dtype=np.float64))
+    nrecords, ndirs, nfreqs = data.shape
+    peaks = _peaks(_smooth(data, grid), grid)
+
+    # Same weights as grid.integrate(), bin by bin
+    weights = grid.bandwidths.copy()
+    weights[-1] += grid.tail_factor
+    energy = (data * weights * grid.dtheta).ravel()
+    m0 = np.bincount(peaks, weights=energy, minlength=energy.size)
+
+    found = np.flatnonzero(m0 > (min_hs / 4) ** 2)
+    hs = 4 * np.sqrt(m0[found])
+    rec, d, f = np.unravel_index(found, data.shape)
+
+    # Rank the partitions within each record, largest first
+    order = np.lexsort((-hs, rec))
+    found, hs, rec, d, f = found[order], hs[order], rec[order], d[order], f[order]
+    rank = np.arange(len(found)) - np.searchsorted(rec, rec)
+    keep = rank < max_partitions
+    hs, rec, d, f, rank = hs[keep], rec[keep], d[keep], f[keep], rank[keep]
+
+    peak_freq = grid.freqs[f]
+    peak_dir = grid.dirs[d]
+    phase_speed = GRAVITY / (2 * np.pi * peak_freq)
+    # The spectrum's directions are the directions that the waves travel, so turn the wind around to match
+    wind_travel = np.radians(np.asarray(wind_dir, dtype=np.float64)[rec]) + np.pi
+    wind_speed = np.asarray(wind_speed, dtype=np.float64)[rec]
+
+    partitions = np.zeros((nrecords, max_partitions), dtype=PARTITION_DTYPE)
+    partitions["hs"][rec, rank] = hs
+    partitions["tp"][rec, rank] = 1 / peak_freq
+    partitions["dp"][rec, rank] = np.degrees(peak_dir) % 360
+    partitions["wind_sea"][rec, rank] = WIND_SEA_FACTOR * wind_speed * np.cos(peak_dir - wind_travel) > phase_speed
+    return partitions
+
+
+def partition_spectrum(spectrum, max_partitions=MAX_PARTITIONS, min_hs=MIN_HS):
+    """ Partitions all of a spectrum's records
+    """
+    return partition(spectrum.data, spectrum.grid, spectrum.block["UA"], spectrum.block["UD"], max_partitions, min_hs)
+
+
+def write_partitions(spectrum, path):
+    """ Writes the partitions of all of a spectrum's records as json, with the records named by their forecast times
+    """
+    partitions = partition_spectrum(spectrum)
+    records = []
+    for rtime, parts in zip(spectrum.block["rtime"], partitions):
+        records.append({
+            "time": time.strftime(SPECTRUM_TIMESPEC, time.localtime(int(rtime))),
+            "partitions": [
+                {
+                    "hs": round(float(part["hs"]), 2),
+                    "tp": round(float(part["tp"]), 1),
+                    "dp": round(float(part["dp"])),
+                    "wind_sea": bool(part["wind_sea"]),
+                }
+                for part in parts if part["hs"] > 0
+            ],
+        })
+    with open(path, "w") as f:
+        json.dump({"records": records}, f)
@@ -0,0 +1,61 @@
+""" The compact binary form of a whole forecast run, for rendering the spectra in the browser
+
+All values are little endian:
+
+| Value       | format   | n                            |
+|-------------+----------+------------------------------|
+| magic       | char[4]  | "NCSP"                       |
+| version     | uint16   | 1                            |
+| n records   | uint16   | 1                            |
+| n dirs      | uint16   | 1                            |
+| n freqs     | uint16   | 1                            |
+| freqs (Hz)  | float32  | n freqs                      |
+| dirs (rads) | float32  | n dirs                       |
+| time (s)    | uint32   | n records                    |
+| wind speed  | float32  | n records                    |
+| wind dir    | float32  | n records                    |
+| Hs (m)      | float32  | n records                    |
+| spectra     | float16  | n records * n dirs * n freqs |
+| time names  | char[10] | n records                    |
+
+The spectra are laid out (record, direction, frequency), like Spectrum.data. Every section starts on a multiple of its
+element size, so the browser can read each one straight into a typed array.
+
+The time names are the server's local time names of the records (SPECTRUM_TIMESPEC), which the images, partitions and
+snapshot are all keyed by, so that the browser doesn't name the records in its own timezone.
+"""
+import time
+import struct
+
+import numpy as np
+
+from .cache import SPECTRUM_TIMESPEC
+
+MAGIC = b"NCSP"
+VERSION = 2
+
+
+def spectra_payload(spectrum):
+    """ Packs all of a spectrum's records into the payload
+    """
+    data = spectrum.data
+    grid = spectrum.grid
+    nrecords = len(data)
+
+    header = MAGIC + struct.pack("<HHHH", VERSION, nrecords, grid.ndirs, grid.nfreqs)
+    return b"".join((
+        header,
+        grid.freqs.astype("<f4").tobytes(),
+        grid.dirs.astype("<f4").tobytes(),
+        spectrum.block["rtime"].astype("<u4").tobytes(),
+        spectrum.block["UA"].astype("<f4").tobytes(),
+        spectrum.block["UD"].astype("<f4").tobytes(),
+        (4 * np.sqrt(grid.integrate(data))).astype("<f4").tobytes(),
+        data.astype("<f2").tobytes(),
+        "".join(time.strftime(SPECTRUM_TIMESPEC, time.localtime(int(t))) for t in spectrum.block["rtime"]).encode(),
+    ))
+
+
+def write_spectra_payload(spectrum, path):
+    with open(path, "wb") as f:
+        f.write(spectra_payload(spectrum))
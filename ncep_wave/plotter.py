@@ -1,11 +1,15 @@
 from io import BytesIO
 import time
+import struct
+import zlib
 
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image, PngImagePlugin
 
 import ncep_wave.terminal as term
 from .cache import create_spectrum_image_path
+from .profiles import RENDER_PROFILES, DEFAULT_PROFILE, SAVE_OPTIONS
 
 
 def write_hs_into_png(pngdata, hs):
@@ -13,28 +17,76 @@ def write_hs_into_png(pngdata, hs):
     tEXt = pngdata.getvalue().find(b"tEXt") + 4
     pngdata.getbuffer()[tEXt:tEXt + 8] = hs.tobytes()
 
-
-def plot_record(record, outdir=".", join_ends=True, normalize_dirs=True, for_web=True):
+    # Fix the chunk's CRC so that the png stays readable by strict decoders
+    length = struct.unpack(">I", pngdata.getbuffer()[tEXt - 8:tEXt - 4])[0]
+    crc = zlib.crc32(pngdata.getbuffer()[tEXt - 4:tEXt + length])
+    pngdata.getbuffer()[tEXt + length:tEXt + length + 4] = struct.pack(">I", crc)
+
+
+def write_sprite(image_paths, outpath):
+    """ Lays the given (equally sized) images out left to right in one png
+
+    Returns the (width, height) of each image in the sprite
+    """
+    images = [plt.imread(path) for path in image_paths]
+    plt.imsave(outpath, np.concatenate(images, axis=1))
+    height, width = images[0].shape[:2]
+    return width, height
+
+
+def save_profiles(fig, outdir, localtime, hs, profiles=(DEFAULT_PROFILE,)):
+    """ Draws the figure once, at the largest profile's size, then scales and encodes it for each format of each of the
+    given render profiles
+
+    Returns the paths of the saved images
+    """
+    fig.set_facecolor("#141b1d")
+    fig.set_dpi(max(RENDER_PROFILES[profile]["dpi"] for profile in profiles))
+    fig.canvas.draw()
+    rendered = Image.frombuffer("RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba()).convert("RGB")
+
+    # The first tEXt chunk is where the Hs is written, as it was in matplotlib's pngs
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("Software", "ncep-wave-plotter")
+
+    outpaths = []
+    for profile in profiles:
+        width, height = (round(inches * RENDER_PROFILES[profile]["dpi"]) for inches in fig.get_size_inches())
+        image = rendered if rendered.size == (width, height) else rendered.resize((width, height), Image.LANCZOS)
+        for ext in RENDER_PROFILES[profile]["formats"]:
+            data = BytesIO()
+            if ext == "png":
+                image.save(data, format=ext, pnginfo=pnginfo, **SAVE_OPTIONS[ext])
+                write_hs_into_png(data, hs)
+            else:
+                image.save(data, format=ext, **SAVE_OPTIONS[ext])
+
+            outpath = create_spectrum_image_path(outdir, localtime, profile, ext)
+            with open(outpath, "wb") as f:
+                f.write(data.getbuffer())
+            outpaths.append(outpath)
+    return outpaths
+
+
+def plot_record(record, outdir=".", join_ends=True, normalize_dirs=True, for_web=True, profiles=(DEFAULT_PROFILE,),
+                pathtime=None):
+    """ Plots a record and saves it for each of the render profiles
+
+    The images are named by the record's local time, unless another name (a SPECTRUM_TIMESPEC string) is given as
+    pathtime
+    """
     localtime = time.localtime(record.rtime)
 
-    # Normalize directions
-    if normalize_dirs:
-        dirs = (2 * np.pi) - (record.dirs - np.pi/2) % (2 * np.pi)
-    else:
-        dirs = record.dirs
+    # The (normalized, joined) directions and the mesh are shared by every record on the grid
+    r, theta = record.grid.mesh(normalize_dirs, join_ends)
 
     if join_ends:
-        # Add 0 and 2pi to remove gap in plot
-        dirs = np.concatenate(([0], dirs, [2 * np.pi]))
-
         # Create 0 and 2pi values by averaging beginning and end of the data on the direction axis
         zero_dir = np.atleast_2d(0.5 * (record.data[0] + record.data[-1]))
         data = np.concatenate((zero_dir, record.data, zero_dir), axis=0)
     else:
         data = record.data
 
-    r, theta = np.meshgrid(record.freqs, dirs)
-
     levels = np.logspace(-5, np.log2(data.max()), num=17, base=2, endpoint=False)
     colors = ("#0066ff", "#00b7ff", "#00e0ff", "#00ffff", "#00ffcc",
               "#00ff99", "#00ff00", "#99ff00", "#ccff00", "#ffff00", "#ffcc00",
@@ -77,15 +129,9 @@ def plot_record(record, outdir=".", join_ends=True, normalize_dirs=True, for_web
 
     term.info(f"Hs: {record.hs}m")
 
-    # Generate the png data
-    png = BytesIO()
-    plt.savefig(png, format="png", facecolor="#141b1d")
-    write_hs_into_png(png, record.hs)
-
-    # Save and close figure
-    outpath = create_spectrum_image_path(outdir, localtime)
-    with open(outpath, "wb") as f:
-        f.write(png.getbuffer())
+    # Save every profile from the one rendered figure, then close it
+    outpaths = save_profiles(fig, outdir, localtime if pathtime is None else pathtime, record.hs, profiles)
     plt.close(fig)
 
-    term.info(outpath)
+    for outpath in outpaths:
+        term.info(outpath)
@@ -0,0 +1,46 @@
+""" Render profiles for spectrum images
+
+Each profile describes one size of spectrum image. The figure is always 6x6 inches, so the dpi determines the pixel
+size of the image (e.g. the desktop profile produces 600x600 images). Every profile is written in each of its formats.
+"""
+from PIL import features
+
+# Pillow can be built without webp support, in which case only pngs are written (and served)
+IMAGE_FORMATS = ("webp", "png") if features.check("webp") else ("png",)
+
+RENDER_PROFILES = {
+    "thumbnail": {"dpi": 24, "formats": IMAGE_FORMATS},
+    "mobile": {"dpi": 64, "formats": IMAGE_FORMATS},
+    "desktop": {"dpi": 100, "formats": IMAGE_FORMATS},
+}
+
+# The desktop png is the canonical image for a forecast time
+DEFAULT_PROFILE = "desktop"
+DEFAULT_FORMAT = "png"
+
+IMAGE_MIMETYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+# Keyword arguments passed through to PIL when saving each format
+SAVE_OPTIONS = {
+    "png": {"compress_level": 6},
+    "webp": {"quality": 80, "method": 4},
+}
+
+
+def parse_profiles(profiles):
+    """ Parses a comma separated list of profile names, raising a ValueError for unknown profiles
+
+    The default profile is always included, since the web server needs its canonical images.
+    """
+    if profiles is None:
+        return tuple(RENDER_PROFILES)
+    names = tuple(p.strip() for p in profiles.split(",") if p.strip())
+    for name in names:
+        if name not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile: {name}")
+    if DEFAULT_PROFILE not in names:
+        names = (DEFAULT_PROFILE,) + names
+    return names
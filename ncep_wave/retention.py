@@ -0,0 +1,221 @@
+import os
+import glob
+import json
+import time
+import shutil
+import threading
+
+import ncep_wave.terminal as term
+
+DATA_GROUP = "data"
+
+
+def directory_size(path):
+    """ Returns the total size (bytes) of the files under path
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def parse_size(size: str):
+    """ Parses a size such as 500M or 2G into bytes
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class Retention:
+    """ Evicts old data runs and forecasts from the cache
+
+    Every run that is added to the cache is recorded in an on-disk manifest, along with its size, so eviction never has
+    to walk the cache. Runs are grouped: all of the data runs are one group, and each station's forecasts are another.
+    The newest run in each group is always kept. Older runs are evicted, oldest first, once there are more than max_runs
+    in their group, once they are older than max_age (seconds), or while the cache is larger than max_bytes.
+
+    Eviction can run in a background thread (see start() and stop()), removing one run at a time.
+    """
+
+    def __init__(self, path, max_bytes=None, max_runs=1, max_age=None):
+        self._path = path
+        self._manifest_path = os.path.join(path, "manifest.json")
+        self.max_bytes = max_bytes
+        self.max_runs = max_runs
+        self.max_age = max_age
+
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._read()
+
+    def _read(self):
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self._entries = json.load(f)["entries"]
+        else:
+            self._entries = {}
+            self._bootstrap()
+
+    def _write(self):
+        if not os.path.isdir(self._path):
+            return
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self._entries}, f, indent=2)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _bootstrap(self):
+        """ Builds the manifest from a cache that predates it. This is the only time the cache is walked
+        """
+        runs = [(path, DATA_GROUP) for path in glob.glob(os.path.join(self._path, "gfs.*", "*", "wave", "station", "*"))
+                if os.path.isdir(path)]
+        runs += [(path, os.path.basename(os.path.dirname(path)))
+                 for path in glob.glob(os.path.join(self._path, "forecast", "*", "*"))]
+        for path, group in runs:
+            self._add(path, group, created=os.stat(path).st_mtime)
+        if runs:
+            term.message(f"Added {len(runs)} existing runs to the cache manifest")
+            self._write()
+
+    def _add(self, path, group, nbytes=None, created=None):
+        key = os.path.relpath(path, self._path)
+        if created is None:
+            # Re-adding a run (e.g. re-rendering a forecast) updates its size, but not its age
+            created = self._entries[key]["created"] if key in self._entries else time.time()
+        self._entries[key] = {
+            "group": group,
+            "bytes": directory_size(path) if nbytes is None else nbytes,
+            "created": created,
+        }
+
+    def contains(self, path):
+        with self._lock:
+            return os.path.relpath(path, self._path) in self._entries
+
+    def add(self, path, group, nbytes=None):
+        """ Records a new run in the manifest. If its size isn't given then it is measured, which only walks the run
+        """
+        with self._lock:
+            self._add(path, group, nbytes)
+            self._write()
+        self._wake.set()
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._entries.values())
+
+    def groups(self):
+        with self._lock:
+            return {entry["group"] for entry in self._entries.values()}
+
+    def drop_group(self, group):
+        """ Evicts every run in the group, including the newest
+        """
+        with self._lock:
+            paths = [path for path, entry in self._entries.items() if entry["group"] == group]
+        for path in paths:
+            self._evict(path)
+
+    def plan(self, now=None):
+        """ Returns the (relative) paths of the runs that should be evicted, in the order they should be evicted
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            by_group = {}
+            for path in sorted(self._entries):
+                by_group.setdefault(self._entries[path]["group"], []).append(path)
+
+            evict = set()
+            candidates = []
+            for paths in by_group.values():
+                # Run paths are named by time, so the last one is the newest
+                older = paths[:-1]
+                if self.max_runs is not None:
+                    evict.update(older[:max(0, len(paths) - self.max_runs)])
+                if self.max_age is not None:
+                    evict.update(p for p in older if now - self._entries[p]["created"] > self.max_age)
+                candidates += older
+
+            candidates.sort(key=lambda p: self._entries[p]["created"])
+            if self.max_bytes is not None:
+                size = sum(entry["bytes"] for path, entry in self._entries.items() if path not in evict)
+                for path in candidates:
+                    if size <= self.max_bytes:
+                        break
+                    if path not in evict:
+                        evict.add(path)
+                        size -= self._entries[path]["bytes"]
+
+            return [path for path in candidates if path in evict]
+
+    def _evict(self, path):
+        full_path = os.path.join(self._path, path)
+        term.message(f"Removing old run {full_path}")
+        shutil.rmtree(full_path, ignore_errors=True)
+
+        # Remove the directories that the run leaves empty, up to the cache itself
+        parent = os.path.dirname(full_path)
+        while os.path.abspath(parent) != os.path.abspath(self._path):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+        with self._lock:
+            self._entries.pop(path, None)
+            self._write()
+
+    def evict_one(self):
+        """ Evicts the first run in the plan. Returns False if there was nothing to evict
+        """
+        plan = self.plan()
+        if not plan:
+            return False
+        self._evict(plan[0])
+        return True
+
+    def evict(self):
+        """ Evicts everything in the plan
+        """
+        while self.evict_one():
+            pass
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            if self.evict_one():
+                continue
+            if self._stopping:
+                return
+            self._wake.wait()
+
+    def start(self):
+        """ Starts evicting in a background thread, which keeps evicting as runs are added until stop() is called
+        """
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="cache-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Finishes any remaining eviction and stops the background thread
+        """
+        if self._thread is None:
+            self.evict()
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
@@ -6,6 +6,7 @@ import struct
 import numpy as np
 
 import ncep_wave.terminal as term
+from .grid import SpectralGrid
 
 # '<Field ID>' <n freqs> <n dirs> <n points> '<grid name>'
 #
@@ -18,6 +19,9 @@ import ncep_wave.terminal as term
 #
 # Indent 1: E(f, theta) X nfreqs*ndirs
 
+RECORD_SUMMARY = re.compile(
+    r"'([^ ]+) *' +(-?[0-9.]+) *(-?[0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+)")
+
 
 def indent(f):
     ident = 0
@@ -36,24 +40,86 @@ class Spectrum:
     ndirs = None
     freqs = None
     dirs = None
+    grid = None
     # records = None
 
     class Record:
+        """ A view of one record in its spectrum's block of records
+
+        Records don't hold any data themselves: every field, including the float32 spectrum, is read from the row of
+        the spectrum's block, so the spectrum data is never copied.
+        """
+
+        __slots__ = ("_spectrum", "_index")
+
+        def __init__(self, spectrum, index):
+            self._spectrum = spectrum
+            self._index = index
+
+        def _field(self, name):
+            return self._spectrum.block[name][self._index]
+
+        @property
+        def rtime(self):
+            return int(self._field("rtime"))
+
+        @property
+        def pid(self):
+            return self._spectrum.station_name
+
+        @property
+        def lat(self):
+            return self._spectrum.lat
+
+        @property
+        def lon(self):
+            return self._spectrum.lon
+
+        @property
+        def depth(self):
+            return float(self._field("depth"))
+
+        @property
+        def UA(self):
+            """ Wind speed at 10m
+            """
+            return float(self._field("UA"))
+
+        @property
+        def UD(self):
+            """ Wind dir
+            """
+            return float(self._field("UD"))
+
+        @property
+        def current(self):
+            return float(self._field("current"))
+
+        @property
+        def crnt_dir(self):
+            return float(self._field("crnt_dir"))
 
-        def __init__(self, rtime, pid, lat, lon, d, UA, UD, crnt, crnt_dir, freqs, dfreqs, dirs):
-            self.rtime = rtime
-            self.pid = pid
-            self.lat = lat
-            self.lon = lon
-            self.depth = d      # Depth
-            self.UA = UA        # Wind speed at 10m
-            self.UD = UD        # Wind dir
-            self.current = crnt
-            self.crnt_dir = crnt_dir
-            self.freqs = freqs
-            self.dfreqs = dfreqs
-            self.dirs = dirs
-            self.data = None
+        @property
+        def data(self):
+            """ The (ndirs, nfreqs) float32 spectrum, as a view into the spectrum's block
+            """
+            return self._field("data")
+
+        @property
+        def grid(self):
+            return self._spectrum.grid
+
+        @property
+        def freqs(self):
+            return self.grid.freqs
+
+        @property
+        def dfreqs(self):
+            return self.grid.dfreqs
+
+        @property
+        def dirs(self):
+            return self.grid.dirs
 
         @property
         def hs(self):
@@ -61,16 +127,25 @@ class Spectrum:
 
             (see Nondirectional and Directional Wave Data Analysis Procedures, sec 3.2.11)
             """
-            # Integrate across directions
-            dir_int = self.data.sum(axis=0) * 2*np.pi/len(self.dirs)
+            return 4 * np.sqrt(self.grid.integrate(self.data))
 
-            # Bandwidths for the frequency bands
-            bw = 0.5 * (self.dfreqs - 1/self.dfreqs) * self.freqs
-            bw[-1] *= 0.5
-            tailf = 0.25 * self.freqs[-1]
+        @property
+        def peak_index(self):
+            """ The (direction, frequency) indices of the most energetic bin of the spectrum
+            """
+            return np.unravel_index(np.argmax(self.data), self.data.shape)
 
-            E = np.dot(dir_int, bw) + tailf * dir_int[-1]
-            return 4 * np.sqrt(E)
+        @property
+        def tp(self):
+            """ Peak period (s), from the peak of the direction-integrated spectrum
+            """
+            return 1 / self.freqs[np.argmax(self.data.sum(axis=0))]
+
+        @property
+        def dp(self):
+            """ Direction (degrees) of the most energetic bin, in the spectrum's direction convention
+            """
+            return np.degrees(self.dirs[self.peak_index[0]]) % 360
 
     def __init__(self, fspec):
         if isinstance(fspec, str):
@@ -80,42 +155,55 @@ class Spectrum:
             self.fspec = fspec
         else:
             raise ValueError(f"Cannot parse {type(fspec)} into a Spectrum")
-        self._records = []
+        self.block = None
+        self._records = None
         self._parse_header()
 
     @property
     def location(self):
         """ Returns the location of the station
         """
-        if len(self._records) == 0:
-            record = next(self.records)
-        else:
-            record = self._records[0]
-        return record.lat, record.lon
+        self.read_all()
+        return self.lat, self.lon
 
     @property
     def station(self):
-        if len(self._records) == 0:
-            record = next(self.records)
-        else:
-            record = self._records[0]
-        return record.pid
+        self.read_all()
+        return self.station_name
 
     @property
     def records(self):
-        while True:
-            rec = self._parse_record()
-            if not rec:
-                return
-            self._records.append(rec)
-            yield rec
+        return iter(self.read_all())
+
+    @property
+    def data(self):
+        """ The (nrecords, ndirs, nfreqs) float32 spectra of all of the records, as a view into the block
+        """
+        self.read_all()
+        return self.block["data"]
 
     def read_all(self):
-        while True:
-            rec = self._parse_record()
-            if not rec:
-                return self._records
-            self._records.append(rec)
+        if self._records is None:
+            self.block = self._parse_records()
+            self._records = [Spectrum.Record(self, i) for i in range(len(self.block))]
+        return self._records
+
+    @staticmethod
+    def record_dtype(ndirs, nfreqs):
+        """ The layout of a record in the block, which matches the binary record format
+
+        (see _parse_binary_records)
+        """
+        return np.dtype([
+            ("rtime", "=u4"),
+            ("depth", "=f4"),
+            ("UA", "=f4"),
+            ("UD", "=f4"),
+            ("current", "=f4"),
+            ("crnt_dir", "=f4"),
+            ("nvalues", "=u4"),
+            ("data", "=f4", (ndirs, nfreqs)),
+        ])
 
     def _parse_header(self):
         if self.fspec.mode == "rb":
@@ -123,11 +211,19 @@ class Spectrum:
         else:
             self._parse_ascii_header()
 
-    def _parse_record(self):
+    def _parse_records(self):
         if self.fspec.mode == "rb":
-            return self._parse_binary_record()
+            return self._parse_binary_records()
         else:
-            return self._parse_ascii_record()
+            return self._parse_ascii_records()
+
+    def _set_grid(self, freqs, dirs):
+        """ Looks up the shared grid for the frequencies and directions
+        """
+        self.grid = SpectralGrid.get(freqs, dirs)
+        self.freqs = self.grid.freqs
+        self.df = self.grid.dfreqs
+        self.dirs = self.grid.dirs
 
     def _parse_ascii_header(self):
         """ Parses the header
@@ -152,11 +248,6 @@ class Spectrum:
             freqs += [float(val) for val in self.fspec.readline().split()]
         if len(freqs) != self.nfreqs:
             raise ValueError(f"Wrong number of frequencies: {len(freqs)} != {self.nfreqs}\n {freqs}")
-        self.freqs = np.array(freqs)
-
-        # Calculate dfreqs
-        df = self.freqs[1:]/self.freqs[:-1]
-        self.df = np.append(df, df[-1])
 
         # Capture directions
         dirs = []
@@ -164,7 +255,8 @@ class Spectrum:
             dirs += [float(val) for val in self.fspec.readline().split()]
         if len(dirs) != self.ndirs:
             raise ValueError(f"Wrong number of directions: {len(dirs)} != {self.ndirs}\n{dirs}")
-        self.dirs = np.array(dirs)
+
+        self._set_grid(freqs, dirs)
 
     def _parse_binary_header(self):
         """
@@ -185,15 +277,11 @@ class Spectrum:
 
         self.nfreqs = struct.unpack("H", self.fspec.read(2))[0]
         freqs = struct.unpack("f" * self.nfreqs, self.fspec.read(4 * self.nfreqs))
-        self.freqs = np.array(freqs)
-
-        # Calculate dfreqs
-        df = self.freqs[1:]/self.freqs[:-1]
-        self.df = np.append(df, df[-1])
 
         self.ndirs = struct.unpack("H", self.fspec.read(2))[0]
         dirs = struct.unpack("f" * self.ndirs, self.fspec.read(4 * self.ndirs))
-        self.dirs = np.array(dirs)
+
+        self._set_grid(freqs, dirs)
 
     def _parse_ascii_record(self):
         """ Parses a single record
@@ -220,24 +308,38 @@ class Spectrum:
 
         # Read Summary
         rsum = self.fspec.readline().strip()
-        m = re.fullmatch(r"'([^ ]+) *' +(-?[0-9.]+) *(-?[0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+) +([0-9.]+)",
-                         rsum)
+        m = RECORD_SUMMARY.fullmatch(rsum)
         if not m:
             raise ValueError(f"Bad record header: {rsum}")
-        params = [m.groups()[0]] + [float(val) for val in m.groups()[1:]]
-        record = Spectrum.Record(rtime, *params, self.freqs, self.df, self.dirs)
+        self.station_name = m.groups()[0]
+        self.lat, self.lon, depth, UA, UD, crnt, crnt_dir = [float(val) for val in m.groups()[1:]]
 
-        data = []
+        lines = []
         while indent(self.fspec) == 2:
-            data += [float(val) for val in self.fspec.readline().split()]
+            lines.append(self.fspec.readline())
+        data = np.fromstring(" ".join(lines), dtype=np.float32, sep=" ")
 
         if len(data) != self.nfreqs * self.ndirs:
             raise ValueError(f"Received an unexpected amount of data: \n{data}\n\n{len(data)} elements")
 
-        record.data = np.array(data).reshape((self.ndirs, self.nfreqs))
-        return record
+        return rtime, depth, UA, UD, crnt, crnt_dir, len(data), data.reshape((self.ndirs, self.nfreqs))
 
-    def _parse_binary_record(self):
+    def _parse_ascii_records(self):
+        """ Parses all of the records into a block
+        """
+        rows = []
+        while True:
+            row = self._parse_ascii_record()
+            if row is None:
+                break
+            rows.append(row)
+
+        block = np.empty(len(rows), dtype=Spectrum.record_dtype(self.ndirs, self.nfreqs))
+        for i, row in enumerate(rows):
+            block[i] = row
+        return block
+
+    def _parse_binary_records(self):
         """
         | Form     | Value         | format              | unit |              n |
         |----------+---------------+---------------------+------+----------------|
@@ -249,26 +351,18 @@ class Spectrum:
         |          | current dir   | float               | rads |              1 |
         |          | spectrum      | counted float array |      | n freqs*n dirs |
         |----------+---------------+---------------------+------+----------------|
+
+        The records have a fixed size, so they are read straight into the block without any copying. A trailing
+        partial record is ignored.
         """
-        try:
-            rtime, depth, UA, UD, crnt, crnt_dir = struct.unpack("Ifffff", self.fspec.read(4 * 6))
-            spec_len = struct.unpack("I", self.fspec.read(4))[0]
-            exp_spec_len = self.nfreqs * self.ndirs
-            if spec_len != exp_spec_len:
-                raise ValueError(f"Received unexpected amount of data: \ngot {spec_len} values, expected {exp_spec_len}")
-            data = struct.unpack("f" * spec_len, self.fspec.read(4 * spec_len))
-
-            record = Spectrum.Record(rtime,
-                                     self.station_name,
-                                     self.lat,
-                                     self.lon,
-                                     depth,
-                                     UA, UD,
-                                     crnt, crnt_dir,
-                                     self.freqs, self.df,
-                                     self.dirs)
-            record.data = np.array(data).reshape((self.ndirs, self.nfreqs))
-
-            return record
-        except struct.error:
-            return None
+        dtype = Spectrum.record_dtype(self.ndirs, self.nfreqs)
+        buf = self.fspec.read()
+        block = np.frombuffer(buf, dtype=dtype, count=len(buf) // dtype.itemsize)
+
+        exp_spec_len = self.nfreqs * self.ndirs
+        bad = block["nvalues"] != exp_spec_len
+        if bad.any():
+            spec_len = block["nvalues"][bad][0]
+            raise ValueError(f"Received unexpected amount of data: \ngot {spec_len} values, expected {exp_spec_len}")
+
+        return block
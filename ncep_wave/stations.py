@@ -0,0 +1,152 @@
+""" A spatial index over every station in a spectral run, for finding the stations nearest to a location
+"""
+import os
+import json
+import math
+import glob
+
+import ncep_wave.terminal as term
+from .spectrum import RECORD_SUMMARY
+
+STATION_INDEX = "stations.json"
+CELL_DEGREES = 5
+EARTH_RADIUS_KM = 6371.0
+
+
+def read_station_location(spec_path):
+    """ Reads a station's (lat, lon) from the first record of its spectral file, without parsing the spectra
+    """
+    with open(spec_path) as f:
+        for line in f:
+            m = RECORD_SUMMARY.fullmatch(line.strip())
+            if m:
+                return float(m.group(2)), float(m.group(3))
+    return None
+
+
+def _hav(angle):
+    return math.sin(angle / 2) ** 2
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """ Great circle distance, by the haversine formula
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = _hav(lat2 - lat1) + math.cos(lat1) * math.cos(lat2) * _hav(lon2 - lon1)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, h)))
+
+
+class StationIndex:
+    """ Stations bucketed into a grid of CELL_DEGREES cells
+
+    A nearest station query searches outwards from the query's cell, one ring of cells at a time, and stops as soon as
+    no station beyond the searched rings could be nearer than the ones already found.
+    """
+
+    def __init__(self, stations: dict, run=None, cell=CELL_DEGREES):
+        self.stations = stations
+        self.run = run
+        self.cell = cell
+        self.nrows = math.ceil(180 / cell)
+        self.ncols = math.ceil(360 / cell)
+        self._buckets = {}
+        for station, (lat, lon) in stations.items():
+            self._buckets.setdefault(self._cell_of(lat, lon), []).append(station)
+
+    def _cell_of(self, lat, lon):
+        row = min(int((lat + 90) // self.cell), self.nrows - 1)
+        col = int(((lon + 180) % 360) // self.cell)
+        return row, col
+
+    @classmethod
+    def build(cls, spec_dir, run=None):
+        """ Builds the index from every station file in an extracted spectral run
+        """
+        stations = {}
+        for spec_path in glob.glob(os.path.join(spec_dir, "*.spec")):
+            station = os.path.basename(spec_path).split(".")[1]
+            try:
+                location = read_station_location(spec_path)
+            except (OSError, UnicodeDecodeError) as e:
+                term.message(f"Unable to read the location of {spec_path}: {e}")
+                continue
+            if location is not None:
+                stations[station] = location
+        return cls(stations, run)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            index = json.load(f)
+        return cls({station: tuple(loc) for station, loc in index["stations"].items()}, index["run"], index["cell"])
+
+    def save(self, path):
+        # Write then rename, so that readers never see a partial index
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"run": self.run, "cell": self.cell, "stations": self.stations}, f)
+        os.replace(tmp_path, path)
+
+    def _ring(self, row, col, r):
+        """ Returns the cells at Chebyshev distance r from (row, col). Columns wrap around, rows don't
+        """
+        cells = set()
+        for dr in range(-r, r + 1):
+            rr = row + dr
+            if not 0 <= rr < self.nrows:
+                continue
+            dcs = range(-r, r + 1) if abs(dr) == r else (-r, r)
+            for dc in dcs:
+                cells.add((rr, (col + dc) % self.ncols))
+        return cells
+
+    def _lower_bound_km(self, lat, r):
+        """ The smallest possible distance from lat to a station that is more than r rings of cells away
+        """
+        span = math.radians(r * self.cell)
+        lat = math.radians(lat)
+        far_lat = min(math.pi / 2, abs(lat) + span)
+        h = min(_hav(span), math.cos(lat) * math.cos(far_lat) * _hav(span))
+        return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, h)))
+
+    def nearest(self, lat, lon, k=1):
+        """ Returns the k stations nearest to (lat, lon), nearest first, as (station, lat, lon, distance_km)
+        """
+        if not -90 <= lat <= 90:
+            raise ValueError(f"Latitude out of range: {lat}")
+        k = min(k, len(self.stations))
+        if k <= 0:
+            return []
+        row, col = self._cell_of(lat, lon)
+        found = []
+        seen = set()
+        for r in range(max(self.nrows, self.ncols)):
+            for cell in self._ring(row, col, r) - seen:
+                seen.add(cell)
+                for station in self._buckets.get(cell, ()):
+                    slat, slon = self.stations[station]
+                    found.append((station, slat, slon, distance_km(lat, lon, slat, slon)))
+            if len(found) >= k:
+                found.sort(key=lambda s: s[3])
+                if found[k - 1][3] <= self._lower_bound_km(lat, r):
+                    break
+        found.sort(key=lambda s: s[3])
+        return found[:k]
+
+
+def update_station_index(cache_path, spec_dir):
+    """ Builds and saves the station index for a spectral run, unless it has already been built for that run
+    """
+    path = os.path.join(cache_path, STATION_INDEX)
+    run = os.path.relpath(spec_dir, cache_path)
+    if os.path.exists(path):
+        try:
+            if StationIndex.load(path).run == run:
+                return path
+        except (ValueError, KeyError):
+            pass
+    term.message(f"Indexing station locations in {spec_dir}")
+    index = StationIndex.build(spec_dir, run)
+    index.save(path)
+    term.message(f"Indexed {len(index.stations)} stations")
+    return path
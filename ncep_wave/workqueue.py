@@ -0,0 +1,195 @@
+""" A queue of render jobs in a shared directory, for spreading a forecast's rendering across machines
+
+Each job is a json file that moves between the queue's directories:
+
+    pending/ -> claimed/ -> done/
+                         -> failed/
+
+Every move is an os.rename, which is atomic, so only one worker can claim a job even if many try at once, and no
+locks or external services are needed: any machine that mounts the directory can take part. A worker touches its
+claimed job while it works on it, so a job whose worker has died can be found by its age and put back in pending/.
+
+Each claim writes a unique token into the claimed job. A worker only finishes a job that still holds its token, so a
+worker whose job was requeued and claimed by another worker can't finish the job out from under the new worker.
+"""
+import os
+import glob
+import json
+import time
+import uuid
+import socket
+import threading
+
+import ncep_wave.terminal as term
+
+QUEUE_DIR = "queue"
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+# A claimed job that hasn't been touched for this long (s) is assumed to have lost its worker
+STALE_AFTER = 300
+
+
+class WorkQueue:
+
+    class Job:
+        """ A claimed job. Work on it within a with block, which completes the job, or fails it if there's an error
+        """
+
+        def __init__(self, queue, name, spec: dict, token):
+            self.queue = queue
+            self.name = name
+            self.spec = spec
+            self.token = token
+            self._stop = threading.Event()
+            self._heartbeat = None
+
+        def __enter__(self):
+            # Touch the claim regularly, so that the job isn't taken for stale while it is being worked on
+            def beat():
+                while not self._stop.wait(self.queue.stale_after / 3):
+                    self.queue.touch(self.name)
+            self._heartbeat = threading.Thread(target=beat, name=f"heartbeat-{self.name}", daemon=True)
+            self._heartbeat.start()
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            self._stop.set()
+            self._heartbeat.join()
+            if exc is None:
+                self.queue.complete(self)
+            elif isinstance(exc, Exception):
+                term.message(f"Job {self.name} failed: {exc}")
+                self.queue.fail(self, str(exc))
+                return True
+            else:
+                # Interrupted, so leave the job for another worker
+                self.queue.release(self)
+            return False
+
+    def __init__(self, path, stale_after=STALE_AFTER):
+        self.path = path
+        self.stale_after = stale_after
+        for state in (PENDING, CLAIMED, DONE, FAILED):
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.path, state, f"{name}.json")
+
+    def _write(self, state, name, spec):
+        # Write then rename, so that a job is never seen half written
+        tmp_path = os.path.join(self.path, f".{name}.{socket.gethostname()}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(spec, f)
+        os.replace(tmp_path, self._path(state, name))
+
+    def _names(self, state):
+        return sorted(name[:-len(".json")] for name in os.listdir(os.path.join(self.path, state))
+                      if name.endswith(".json"))
+
+    def put(self, name, spec: dict):
+        """ Adds a job to the queue. Names must be unique, and jobs are claimed in name order
+        """
+        self._write(PENDING, name, spec)
+
+    def claim(self):
+        """ Claims the first pending job, or returns None if there aren't any
+        """
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        for name in self._names(PENDING):
+            try:
+                # Touch the job before claiming it, since a rename keeps the time it was queued, which would make the
+                # claim look stale straight away
+                os.utime(self._path(PENDING, name))
+                os.rename(self._path(PENDING, name), self._path(CLAIMED, name))
+                with open(self._path(CLAIMED, name)) as f:
+                    spec = json.load(f)
+            except FileNotFoundError:
+                # Another worker got there first, or the job was requeued
+                continue
+            spec.pop("error", None)
+            token = f"{worker}:{uuid.uuid4().hex}"
+            self._write(CLAIMED, name, dict(spec, claim=token))
+            spec.pop("claim", None)
+            term.message(f"{worker} claimed job {name}")
+            return WorkQueue.Job(self, name, spec, token)
+        return None
+
+    def touch(self, name):
+        try:
+            os.utime(self._path(CLAIMED, name))
+        except FileNotFoundError:
+            pass
+
+    def _finish(self, job, state, error=None):
+        """ Moves the job from claimed/ to the given state, as long as it still holds the job's claim
+        """
+        # Take the job out of claimed/ first, so that it can't be requeued or claimed while its token is checked
+        finishing = os.path.join(self.path, CLAIMED, f".{job.name}.{job.token.replace(':', '.')}")
+        try:
+            os.rename(self._path(CLAIMED, job.name), finishing)
+        except FileNotFoundError:
+            # The job was taken for stale and requeued, so it will be done again. Its outputs are just rewritten
+            term.message(f"Job {job.name} was requeued while it was being worked on")
+            return
+        with open(finishing) as f:
+            claimed = json.load(f)
+        if claimed.get("claim") != job.token:
+            # Requeued and claimed by another worker, which will finish it
+            os.rename(finishing, self._path(CLAIMED, job.name))
+            term.message(f"Job {job.name} was claimed by another worker while it was being worked on")
+            return
+
+        if error is None:
+            os.rename(finishing, self._path(state, job.name))
+        else:
+            self._write(state, job.name, dict(job.spec, error=error))
+            os.remove(finishing)
+
+    def complete(self, job):
+        self._finish(job, DONE)
+
+    def release(self, job):
+        self._finish(job, PENDING)
+
+    def fail(self, job, error):
+        self._finish(job, FAILED, error)
+
+    def state(self, name):
+        """ Returns which of the queue's directories the job is in, or None if it isn't in the queue
+        """
+        # A job can move while it is being looked for, so look twice before deciding that it's missing
+        for _ in range(2):
+            for state in (DONE, FAILED, CLAIMED, PENDING):
+                if os.path.exists(self._path(state, name)):
+                    return state
+            if glob.glob(os.path.join(glob.escape(os.path.join(self.path, CLAIMED)), f".{glob.escape(name)}.*")):
+                # Being finished by its worker
+                return CLAIMED
+        return None
+
+    def error(self, name):
+        with open(self._path(FAILED, name)) as f:
+            return json.load(f).get("error")
+
+    def remove(self, name):
+        for state in (PENDING, CLAIMED, DONE, FAILED):
+            try:
+                os.remove(self._path(state, name))
+            except FileNotFoundError:
+                pass
+
+    def requeue_stale(self, now=None):
+        """ Moves the claimed jobs that haven't been touched for stale_after back to pending
+        """
+        now = time.time() if now is None else now
+        for name in self._names(CLAIMED):
+            try:
+                if now - os.stat(self._path(CLAIMED, name)).st_mtime <= self.stale_after:
+                    continue
+                os.rename(self._path(CLAIMED, name), self._path(PENDING, name))
+            except FileNotFoundError:
+                continue
+            term.message(f"Requeued stale job {name}")
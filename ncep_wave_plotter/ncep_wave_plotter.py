@@ -3,29 +3,61 @@ import sys
 import yaml
 import argparse
 
-from ncep_wave.forecast import make_forecast, plot_binary_data
+from ncep_wave.forecast import make_forecasts, make_queued_forecasts, plot_binary_data, write_snapshot, work, \
+    RECORDS_PER_JOB
 from ncep_wave.config import Config
 from ncep_wave.cache import Cache, DEFAULT_CACHE
+from ncep_wave.profiles import parse_profiles, RENDER_PROFILES
+from ncep_wave.retention import Retention, parse_size
+from ncep_wave.stations import StationIndex, STATION_INDEX
+from ncep_wave.workqueue import WorkQueue, QUEUE_DIR
 import ncep_wave.terminal as term
 
 
 def main():
     parser = argparse.ArgumentParser("A tool for producing plots from ncep wave data")
-    parser.add_argument("action", choices=["forecast", "plot-binary"], help="Plot a forecast")
+    parser.add_argument("action", choices=["forecast", "plot-binary", "nearest", "worker"],
+                        help="Plot a forecast, find the stations nearest to --lat/--lon, or render queued forecast "
+                        "jobs from the cache's work queue")
     parser.add_argument("-s", "--station", help="Station to generate plots for")
     parser.add_argument("-n", "--station_name", default=None, help="Optional name for the station")
     parser.add_argument("-f", "--config", help="Config file with a list of stations to generate plots for")
     parser.add_argument("-i", "--input", default=None, help="Input file for binary data")
     parser.add_argument("-o", "--outdir", default=DEFAULT_CACHE, help="Output directory")
+    parser.add_argument("-p", "--profiles", default=None,
+                        help=f"Comma separated render profiles to generate (default: {','.join(RENDER_PROFILES)})")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of stations to render in parallel (default: the number of CPUs)")
+    parser.add_argument("-q", "--queue", action="store_true",
+                        help="Split the forecast into jobs on the cache's work queue, for workers to render")
+    parser.add_argument("--records-per-job", type=int, default=RECORDS_PER_JOB,
+                        help=f"Number of records in each queued job (default: {RECORDS_PER_JOB})")
+    parser.add_argument("--exit-when-empty", action="store_true",
+                        help="Stop the worker when the work queue is empty, rather than waiting for more jobs")
+    parser.add_argument("--keep-runs", type=int, default=1,
+                        help="Number of data runs, and forecasts per station, to keep in the cache (default: 1)")
+    parser.add_argument("--max-cache-size", type=parse_size, default=None,
+                        help="Evict old runs while the cache is larger than this, e.g. 2G (default: no limit)")
+    parser.add_argument("--max-age", type=float, default=None,
+                        help="Evict runs older than this many hours (default: no limit)")
+    parser.add_argument("--lat", type=float, default=None, help="Latitude to find the nearest stations to")
+    parser.add_argument("--lon", type=float, default=None, help="Longitude to find the nearest stations to")
+    parser.add_argument("-k", "--nearest", type=int, default=5, help="Number of nearest stations to find")
 
     args = parser.parse_args()
 
     outdir = os.path.expanduser(args.outdir)
 
+    try:
+        profiles = parse_profiles(args.profiles)
+    except ValueError as e:
+        term.message(f"ERROR: {e}")
+        sys.exit(1)
+
     if args.action == "forecast":
 
         if args.station:
-            stations = [{args.station: args.station_name}]
+            stations = {args.station: args.station_name}
             term.message(f"station: {args.station}")
         elif args.config:
             try:
@@ -39,13 +71,38 @@ def main():
             parser.print_help()
             sys.exit(1)
 
-        cache = Cache(path=outdir, auto_clean=stations)
+        max_age = None if args.max_age is None else args.max_age * 3600
+        retention = Retention(outdir, max_bytes=args.max_cache_size, max_runs=args.keep_runs, max_age=max_age)
+        cache = Cache(path=outdir, auto_clean=stations, retention=retention)
 
-        for station, name in stations.items():
-            make_forecast(station, name, cache)
+        # Old runs are evicted in the background while the new ones are rendered
+        cache.start_clean()
+        if args.queue:
+            summaries = make_queued_forecasts(stations, cache, profiles, args.records_per_job)
+        else:
+            summaries = make_forecasts(stations, cache, profiles, args.jobs)
+        if summaries:
+            write_snapshot(cache, summaries)
+        cache.finish_clean()
     if args.action == "plot-binary":
         term.message("Plotting binary spectrum")
         plot_binary_data(args.outdir, args.input)
+    if args.action == "worker":
+        term.message("Rendering queued forecast jobs")
+        work(outdir, WorkQueue(os.path.join(outdir, QUEUE_DIR)), args.exit_when_empty)
+    if args.action == "nearest":
+        if args.lat is None or args.lon is None:
+            term.message("ERROR: --lat and --lon must be given")
+            sys.exit(1)
+        if args.nearest <= 0:
+            term.message("ERROR: -k/--nearest must be at least 1")
+            sys.exit(1)
+        index_path = os.path.join(outdir, STATION_INDEX)
+        if not os.path.exists(index_path):
+            term.message(f"ERROR: {index_path} does not exist. It is built when a forecast is fetched")
+            sys.exit(1)
+        for station, lat, lon, distance in StationIndex.load(index_path).nearest(args.lat, args.lon, args.nearest):
+            term.info(f"{station}\t{lat:.2f}\t{lon:.2f}\t{distance:.1f}km")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,44 @@
+import os
+import gzip
+
 from setuptools import find_packages, setup
+from setuptools.command.build_py import build_py
+
+# Brotli is in the build requirements (pyproject.toml), but a build without it still writes the gzip copies
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".html", ".json", ".svg")
+
+
+def precompress(path):
+    """ Writes the best gzip and brotli copies of a file next to it, when they are smaller than the file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    copies = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        copies[".br"] = brotli.compress(data, quality=11)
+    for suffix, compressed in copies.items():
+        if len(compressed) < len(data):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            print(f"precompressed {path + suffix}")
+
+
+class BuildPyPrecompressed(build_py):
+    """ Builds the packages and precompresses the web server's static files
+    """
+
+    def run(self):
+        super().run()
+        for root, _, files in os.walk(os.path.join(self.build_lib, "ncep_forecast", "static")):
+            for name in files:
+                if name.endswith(PRECOMPRESS_EXTENSIONS):
+                    precompress(os.path.join(root, name))
+
 
 setup(
     name="ncep-wave-forecast",
@@ -10,8 +50,16 @@ setup(
         "flask",
         "numpy",
         "matplotlib",
+        "pillow",
         "pyyaml"
     ],
+    extras_require={
+        "brotli": ["brotli"],
+        "server": ["twisted"]
+    },
+    cmdclass={
+        "build_py": BuildPyPrecompressed
+    },
     entry_points={
         "console_scripts": [
             "ncep-wave-plotter=ncep_wave_plotter.ncep_wave_plotter:main"